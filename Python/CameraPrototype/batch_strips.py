@@ -0,0 +1,198 @@
+#---------------------------------------------
+# Processes a directory of strip images in
+# parallel, the way ProcessStripsImage.ipynb
+# does one image at a time, and writes each
+# image's results to disk as soon as it is
+# done (as columnar .npz by default, see
+# process_strips.save_columns).
+#
+# A checkpoint file lists the images already
+# processed, so an interrupted run picks up
+# where it left off with --resume.
+#
+# Usage:
+#   python batch_strips.py img_dir save_dir [options]
+#---------------------------------------------
+
+import numpy as np
+import cv2
+import os
+import re
+import sys
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import process_strips as p
+
+
+save_header = ['Column [px]', 'Row Start [px]', 'Row End [px]', 'Amplitudes [0-255]', 'Means [px]', 'Std. Dev. [px]', 'Error Amp [px]', 'Error Mean [px]', 'Error Std. Dev. [px]', 'dx']
+checkpoint_header = ['Image', 'Results', 'Columns', 'Min Strips', 'Seconds']
+checkpoint_name = "checkpoint.csv"
+
+
+#---------------------------------------------
+# List the images in a directory whose names
+# match a regex, in order
+#---------------------------------------------
+def list_images(img_dir, match_pattern):
+	filenames = sorted(next(os.walk(img_dir))[2])
+	return [fn for fn in filenames if re.search(match_pattern, fn)]
+
+
+#---------------------------------------------
+# Load the names of the images a previous run
+# already finished
+#---------------------------------------------
+def load_checkpoint(filename):
+	done = set()
+	if (os.path.exists(filename)):
+		with open(filename, mode='r', newline='') as infile:
+			reader = csv.reader(infile, delimiter=',')
+			next(reader, None)
+			for rows in reader:
+				if (len(rows) > 0):
+					done.add(rows[0])
+	return done
+
+
+#---------------------------------------------
+# Process one image and save its results.
+# Runs in a worker process, so only the short
+# summary goes back to the parent.
+#---------------------------------------------
+def process_image(img_dir, fn, save_dir, options):
+	t = time.perf_counter()
+
+	if (options.pyramid > 0):
+		# Find the ROI on a pyramid level and keep only the
+		# full resolution tile of it
+		img_gray, roi, (h, w) = p.load_ROI_tile(os.path.join(img_dir, fn), options.rect, options.gauss_radius, options.pyramid, options.center)
+		origin = roi[0], roi[2]
+	else:
+		img = cv2.imread(os.path.join(img_dir, fn))
+		if img is None:
+			raise IOError("Could not read %s" % fn)
+		img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+		del img
+
+		h, w = np.shape(img_gray)
+		rect = [options.rect[0] if options.rect[0] > 0 else h-1, options.rect[1] if options.rect[1] > 0 else w-1]
+
+		# Center the ROI on the brightest (or darkest) part of
+		# the image, or on the middle of it
+		if (options.center == "image"):
+			loc = (int(w/2.0), int(h/2.0))
+		else:
+			img_blur, (minVal, maxVal, minLoc, maxLoc) = p.find_min_max(img_gray, options.gauss_radius)
+			del img_blur
+			loc = maxLoc if options.center == "brightest" else minLoc
+		roi = p.check_ROI(loc, rect, w, h)
+		origin = (0, 0)
+
+	# With sub-pixel edges, process_ROI thresholds the raw image
+	# itself, at the level the chosen method would use.  With
+	# a pyramid, the levels come from the tile alone
+	if (options.threshold == "otsu"):
+		level, img_thresh = cv2.threshold(img_gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+	elif (options.threshold == "binary"):
+		level, img_thresh = options.level, p.binary_threshold(img_gray, options.level, 255)
+	else:
+		level, img_thresh = None, p.adaptive_threshold(img_gray, 255, options.window)
+
+	if (options.edges):
+		img_roi, fits, numstrips = p.process_ROI(img_gray, roi, options.step, 0, level, options.stddev, edges=options.edges, origin=origin)
+	else:
+		img_roi, fits, numstrips = p.process_ROI(img_thresh, roi, options.step, 0, options.min_thresh, options.stddev, origin=origin)
+
+	# Write to a temporary file first, so a half-written file
+	# is never mistaken for a result
+	name = "%s_results.%s" % (os.path.splitext(fn)[0], options.format)
+	tmp = os.path.join(save_dir, name + ".part")
+	if (options.format == "npz"):
+		p.save_columns(tmp, fits)
+	else:
+		p.save_results(tmp, fits, save_header)
+	os.replace(tmp, os.path.join(save_dir, name))
+
+	return [fn, name, len(fits), numstrips, "%.3f" % (time.perf_counter() - t)]
+
+
+#---------------------------------------------
+# Process every image, keeping at most
+# 'inflight' images queued or running at once
+# and recording each one in the checkpoint as
+# it finishes
+#---------------------------------------------
+def process_directory(img_dir, save_dir, options):
+	p.make_dir(save_dir)
+
+	checkpoint = os.path.join(save_dir, checkpoint_name)
+	done = load_checkpoint(checkpoint) if options.resume else set()
+	todo = [fn for fn in list_images(img_dir, options.pattern) if fn not in done]
+	print("%d images to process, %d already done" % (len(todo), len(done)))
+
+	failed = 0
+	mode = 'a' if options.resume and os.path.exists(checkpoint) else 'w'
+	with open(checkpoint, mode, newline='') as log, ProcessPoolExecutor(options.workers) as pool:
+		writer = csv.writer(log, delimiter=',')
+		if (mode == 'w'):
+			writer.writerow(checkpoint_header)
+
+		pending = {}
+		images = iter(todo)
+		while True:
+			for fn in images:
+				pending[pool.submit(process_image, img_dir, fn, save_dir, options)] = fn
+				if (len(pending) >= options.inflight):
+					break
+			if (not pending):
+				break
+
+			finished, __ = wait(pending, return_when=FIRST_COMPLETED)
+			for future in finished:
+				fn = pending.pop(future)
+				try:
+					row = future.result()
+				except Exception as e:
+					failed = failed + 1
+					print("     %s failed: %s" % (fn, e), file=sys.stderr)
+					continue
+				writer.writerow(row)
+				log.flush()
+				print("     %s: %d columns, min %d strips, %s s" % (fn, row[2], row[3], row[4]))
+
+	return len(todo) - failed, failed
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Process a directory of strip images in parallel")
+	parser.add_argument("img_dir", help="directory of images")
+	parser.add_argument("save_dir", help="directory where results are saved")
+	parser.add_argument("--pattern", default=r"^.*\.(png|bmp|tif|tiff|jpg)$", help="filename regex to match")
+	parser.add_argument("--rect", type=int, nargs=2, default=[250, 250], metavar=("H", "W"), help="size of rectangle to analyze, -1 for the whole image")
+	parser.add_argument("--step", type=int, default=1, help="analyze every nth column of the rectangle")
+	parser.add_argument("--center", choices=["brightest", "darkest", "image"], default="brightest", help="where to center the ROI")
+	parser.add_argument("--gauss-radius", type=int, default=41, help="blur radius for finding the brightest/darkest spot")
+	parser.add_argument("--pyramid", type=int, default=0, metavar="LEVELS", help="find the ROI on this level of the image pyramid and load only its tile")
+	parser.add_argument("--threshold", choices=["otsu", "binary", "adaptive"], default="otsu")
+	parser.add_argument("--level", type=int, default=127, help="level for the binary threshold")
+	parser.add_argument("--window", type=int, default=51, help="window for the adaptive threshold")
+	parser.add_argument("--min-thresh", type=float, default=20, help="minimum height of a strip in the thresholded image")
+	parser.add_argument("--stddev", type=float, default=3.0, help="cull strip widths this many standard deviations from the mean")
+	parser.add_argument("--edges", choices=["linear", "parabolic"], default=None, help="find strip edges to a fraction of a pixel")
+	parser.add_argument("--format", choices=["npz", "csv"], default="npz", help="columnar .npz results, or the old CSV")
+	parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--inflight", type=int, default=0, help="most images queued or running at once (default twice the workers)")
+	parser.add_argument("--resume", action="store_true", help="skip images listed in the checkpoint")
+	options = parser.parse_args()
+
+	if (options.edges and options.threshold == "adaptive"):
+		parser.error("--edges needs a global threshold level (otsu or binary)")
+	if (options.inflight <= 0):
+		options.inflight = 2 * options.workers
+
+	t = time.perf_counter()
+	processed, failed = process_directory(options.img_dir, options.save_dir, options)
+	print("Processed %d images (%d failed) in %.1f s" % (processed, failed, time.perf_counter() - t))
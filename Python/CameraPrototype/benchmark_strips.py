@@ -0,0 +1,150 @@
+#---------------------------------------------
+# Benchmarks process_strips.process_ROI on a
+# real strips image against the original
+# column-by-column loop, and checks that both
+# give the same fits
+#
+# Usage:
+#   python benchmark_strips.py [image] [--step N] [--tile N] [--repeat N]
+#---------------------------------------------
+
+import numpy as np
+import cv2
+import os
+import sys
+import time
+import argparse
+
+import process_strips as p
+
+
+default_image = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Utils", "ConfigurationFiles_and_Templates",
+	"0_Calibration", "1_Camera", "2_10Strips_PixMicronCalibTemplate_10mpx_4_12.png")
+
+
+#---------------------------------------------
+# The original process_ROI, kept as the
+# reference for the benchmark
+#---------------------------------------------
+def legacy_process_ROI(img, roi, step, offset, minThresh, stdDev):
+
+	(start, stop, left, right) = roi
+	img_p = img.copy()
+
+	fits = []
+	cols = []
+	stripcount = []
+
+	img_p = img[start:stop, left:right]
+
+	for col in range(0, right-left-1, step):
+		cols.append(col)
+
+		y = np.zeros(stop-start)
+		x = np.zeros(stop-start)
+
+		for row in range(0, stop-start-1):
+			x[row] = row + start
+			y[row] = y[row] + img_p[row][col]
+
+		x = np.array(x)
+		y = np.array(y)
+
+		centers, widths = p.get_strips(x, y, minThresh, stdDev)
+
+		z = np.where(centers > 0)
+		centers = centers[z]
+		widths = widths[z]
+
+		stripcount.append(len(centers))
+
+		amps = np.ones_like(centers) * minThresh
+		means = centers
+		devs = np.sqrt(1.0/3.0) * widths
+
+		err_amps = np.ones_like(centers)
+		err_widths = 2.0 * np.ones_like(centers)
+		err_means = err_widths / widths
+		err_devs = (np.sqrt(1.0/3.0) * err_widths) * np.ones_like(centers)
+
+		if (len(amps) and len(means) and len(devs)):
+			a, m, s, ea, em, ed = zip(*sorted(zip(amps, means, devs, err_amps, err_means, err_devs), key=lambda pair: pair[1]))
+
+			dd = tuple(np.gradient(m))
+
+			fits.append([col, left, right, a, m, s, ea, em, ed, dd])
+
+	return img_p, fits, min(stripcount)
+
+
+#---------------------------------------------
+# Load an image, threshold it the way the
+# notebook does, and pick the largest ROI
+#---------------------------------------------
+def prepare(filename, tile):
+	img = cv2.imread(filename)
+	if img is None:
+		sys.exit("Could not read %s" % filename)
+	img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+	img_gray = np.tile(img_gray, (tile, 1))
+	img_otsu = p.otsu_threshold(img_gray, 0, 255)
+
+	h, w = np.shape(img_otsu)
+	rect = [h-22, w-22]
+	roi = p.check_ROI((int(w/2.0), int(h/2.0)), rect, w, h)
+	return img_otsu, roi
+
+
+#---------------------------------------------
+# Compare two lists of fits, treating NaN as
+# equal to NaN
+#---------------------------------------------
+def same_fits(fits_a, fits_b):
+	if len(fits_a) != len(fits_b):
+		return False
+	for row_a, row_b in zip(fits_a, fits_b):
+		if row_a[:3] != row_b[:3]:
+			return False
+		for va, vb in zip(row_a[3:], row_b[3:]):
+			if not np.array_equal(np.array(va, dtype=np.float64), np.array(vb, dtype=np.float64), equal_nan=True):
+				return False
+	return True
+
+
+#---------------------------------------------
+# Time the best of a few runs
+#---------------------------------------------
+def best_time(function, repeat, *args):
+	best = np.inf
+	for i in range(repeat):
+		t = time.perf_counter()
+		result = function(*args)
+		best = min(best, time.perf_counter() - t)
+	return best, result
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark process_ROI on a strips image")
+	parser.add_argument("image", nargs="?", default=default_image)
+	parser.add_argument("--step", type=int, default=1, help="analyze every nth column")
+	parser.add_argument("--tile", type=int, default=1, help="stack the image vertically n times to make a taller ROI")
+	parser.add_argument("--repeat", type=int, default=3)
+	args = parser.parse_args()
+
+	img, roi = prepare(args.image, args.tile)
+	(start, stop, left, right) = roi
+	print("Image: %s" % os.path.normpath(args.image))
+	print("ROI: rows %d-%d, columns %d-%d, step %d" % (start, stop, left, right, args.step))
+
+	t_new, (img_new, fits_new, count_new) = best_time(p.process_ROI, args.repeat, img, roi, args.step, 0, 20, 3.0)
+	print("process_ROI:        %10.4f s  (%d columns with strips, min %d strips)" % (t_new, len(fits_new), count_new))
+
+	try:
+		t_old, (img_old, fits_old, count_old) = best_time(legacy_process_ROI, 1, img, roi, args.step, 0, 20, 3.0)
+	except (TypeError, ValueError) as e:
+		# The original loop fails on columns with no strips or a single strip
+		print("legacy process_ROI failed: %s" % e)
+	else:
+		print("legacy process_ROI: %10.4f s" % t_old)
+		print("Speedup: %.1fx" % (t_old / t_new))
+		print("Same fits: %s" % (same_fits(fits_new, fits_old) and count_new == count_old))
@@ -62,6 +62,57 @@ def find_min_max(img, gauss_radius):
 	img_blur = cv2.GaussianBlur(img, (gauss_radius, gauss_radius), 0)
 
 	return img_blur, cv2.minMaxLoc(img_blur)
+
+
+#---------------------------------------------
+# Find the ROI around the brightest (or
+# darkest) part of an image on a level of its
+# Gaussian pyramid, so the blur never runs on
+# the full frame.  Each level halves the
+# image; the blur radius shrinks with it.
+#---------------------------------------------		
+def find_ROI_pyramid(img, rect, gauss_radius, levels=3, center="brightest"):
+	h, w = np.shape(img)[:2]
+
+	small = img
+	for i in range(levels):
+		small = cv2.pyrDown(small)
+	scale = 2**levels
+
+	img_blur, (minVal, maxVal, minLoc, maxLoc) = find_min_max(small, max(1, int(gauss_radius / scale)))
+	loc = maxLoc if center == "brightest" else minLoc
+
+	# pyrDown keeps the even pixels, so pixel i of the level
+	# sits on pixel i*scale of the full image
+	return check_ROI((loc[0] * scale, loc[1] * scale), rect, w, h)
+
+
+#---------------------------------------------
+# Load only the ROI of an image file, found
+# on a pyramid level, at full resolution.
+# Returns the tile, the ROI in the frame, and
+# the size of the frame.  Only one grayscale
+# frame is ever held, and it is released
+# before returning, so peak memory is about
+# one frame plus a third for the pyramid.
+#---------------------------------------------		
+def load_ROI_tile(filename, rect, gauss_radius, levels=3, center="brightest"):
+	img = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+	if img is None:
+		raise IOError("Could not read %s" % filename)
+
+	h, w = np.shape(img)
+	rect = [rect[0] if rect[0] > 0 else h-1, rect[1] if rect[1] > 0 else w-1]
+
+	if (center == "image"):
+		roi = check_ROI((int(w/2.0), int(h/2.0)), rect, w, h)
+	else:
+		roi = find_ROI_pyramid(img, rect, gauss_radius, levels, center)
+
+	(start, stop, left, right) = roi
+	tile = img[start:stop, left:right].copy()
+
+	return tile, roi, (h, w)
 	
 	
 #---------------------------------------------
@@ -91,34 +142,326 @@ def otsu_threshold(img, lo, hi):
     return img_edges
 	
 
+#---------------------------------------------
+# Thresholds of one frame, from tables built
+# once.  The (optionally blurred) image is
+# made with the engine, and its histogram,
+# local means and integral images of the
+# values and the squared values the first
+# time they are needed; after that any
+# adaptive threshold, Otsu level or local
+# contrast mask is a few lookups, so sweeping
+# windows and levels while tuning is cheap.
+#
+# Adaptive thresholds are box means (cv2's
+# ADAPTIVE_THRESH_MEAN_C) unless asked for
+# the Gaussian-weighted mean that
+# adaptive_threshold and the notebooks use
+# (ADAPTIVE_THRESH_GAUSSIAN_C); the two differ
+# on a few percent of the pixels of a strips
+# image.  Box windows are cut short at the
+# image border rather than padded, so pixels
+# near the edge can differ slightly from cv2.
+#---------------------------------------------		
+class ThresholdEngine(object):
+	def __init__(self, img, gauss_radius=0):
+		self.img = np.asarray(img)
+		if (gauss_radius > 0):
+			# Gaussian blur radius must be odd
+			if (gauss_radius % 2 == 0):
+				gauss_radius = gauss_radius + 1
+			self.img = cv2.GaussianBlur(self.img, (gauss_radius, gauss_radius), 0)
+
+		self.h, self.w = np.shape(self.img)[:2]
+		self.sums = None
+		self.squares = None
+		self.means = {}
+		self.gaussians = {}
+		self.rounded = {}
+		self.stds = {}
+		self.otsu = None
+
+	# Integral images of the values and the squared values
+	def integrals(self):
+		if (self.sums is None):
+			self.sums, self.squares = cv2.integral2(self.img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+		return self.sums, self.squares
+
+	# Sum of a table over a window x window box around every
+	# pixel, and the number of pixels in each box.  Whole rows
+	# of the table are differenced first, then columns
+	def box(self, table, window):
+		half = int(window) // 2
+		rows = np.arange(self.h)
+		cols = np.arange(self.w)
+		r0, r1 = np.clip(rows - half, 0, self.h), np.clip(rows + half + 1, 0, self.h)
+		c0, c1 = np.clip(cols - half, 0, self.w), np.clip(cols + half + 1, 0, self.w)
+
+		band = table[r1] - table[r0]
+		total = band[:, c1] - band[:, c0]
+		count = np.outer(r1 - r0, c1 - c0)
+		return total, count
+
+	# Local mean over a window, cached by window size
+	def local_mean(self, window):
+		if (window not in self.means):
+			total, count = self.box(self.integrals()[0], window)
+			self.means[window] = total / count
+		return self.means[window]
+
+	# Local standard deviation over a window, cached by
+	# window size
+	def local_std(self, window):
+		if (window not in self.stds):
+			mean = self.local_mean(window)
+			squares, count = self.box(self.integrals()[1], window)
+			self.stds[window] = np.sqrt(np.maximum(squares / count - mean**2, 0))
+		return self.stds[window]
+
+	# Local Gaussian-weighted mean over a window, cached by
+	# window size.  The same blur as cv2's
+	# ADAPTIVE_THRESH_GAUSSIAN_C, borders included, which
+	# blurs in float32 and rounds the mean of an 8 bit image
+	def local_gaussian(self, window):
+		if (window not in self.gaussians):
+			mean = cv2.GaussianBlur(self.img.astype(np.float32), (window, window), 0, borderType=cv2.BORDER_REPLICATE|cv2.BORDER_ISOLATED)
+			self.gaussians[window] = np.rint(mean).astype(np.int16) if self.img.dtype == np.uint8 else mean
+		return self.gaussians[window]
+
+	# Adaptive threshold: pixels brighter than the local mean,
+	# plus k local standard deviations, minus c are set to hi.
+	# The mean is a box mean, as cv2's ADAPTIVE_THRESH_MEAN_C
+	# (which rounds the mean of an 8 bit image first), or with
+	# gaussian=True the weighted mean of adaptive_threshold,
+	# which it then matches exactly when k = 0.  The standard
+	# deviation is always over the box
+	def adaptive(self, window, c=2, hi=255, k=0.0, gaussian=False):
+		if (gaussian):
+			level = self.local_gaussian(window) - c
+		elif (self.img.dtype == np.uint8):
+			if (window not in self.rounded):
+				self.rounded[window] = np.rint(self.local_mean(window)).astype(np.int16)
+			level = self.rounded[window] - c
+		else:
+			level = self.local_mean(window) - c
+		if (k != 0):
+			level = level + k * self.local_std(window)
+		return np.multiply(self.img > level, hi, dtype=np.uint8)
+
+	# Otsu's level, from the histogram of the image
+	def otsu_level(self):
+		if (self.otsu is None):
+			if (self.img.dtype != np.uint8):
+				self.otsu = cv2.threshold(self.img.astype(np.uint8), 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)[0]
+			else:
+				histogram = np.bincount(self.img.ravel(), minlength=256)
+				p = histogram / float(histogram.sum())
+				levels = np.arange(256)
+				omega = np.cumsum(p)
+				mu = np.cumsum(p * levels)
+				with np.errstate(divide='ignore', invalid='ignore'):
+					between = (mu[-1] * omega - mu)**2 / (omega * (1 - omega))
+				self.otsu = float(np.argmax(np.nan_to_num(between)))
+		return self.otsu
+
+	# Simple binary threshold at a level
+	def binary(self, lo, hi=255):
+		return np.multiply(self.img > lo, hi, dtype=np.uint8)
+
+	# Threshold at Otsu's level
+	def otsu_threshold(self, hi=255):
+		return self.binary(self.otsu_level(), hi)
+
+	# Mask of the pixels whose neighbourhood has at least
+	# min_contrast of standard deviation, i.e. where there
+	# are strip edges rather than flat background
+	def contrast_mask(self, window, min_contrast):
+		return self.local_std(window) >= min_contrast
+
+
 #---------------------------------------------
 # Get the all the centers and widths of a 
 # simple step function
 #---------------------------------------------		
 def get_centers_and_widths(x, y, minThresh):
-	from itertools import groupby
-	from operator import itemgetter
 
 	# Peaks need to be this tall to proceed
-	peaks = np.where(y >= minThresh)[0]
+	rise, fall = get_runs(np.asarray(y) >= minThresh)
 
-	centers = []
-	widths = []
+	left = np.asarray(x)[rise]
+	widths = fall - rise
 
-	for k, g in groupby(enumerate(peaks), lambda ix : ix[0] - ix[1]):
-		peak = list(map(itemgetter(1), g))
+	centers = (widths / 2.0) + left
 
-		left = x[peak[0]]
-		width = len(peak)
-		
-		centers.append((width / 2.0) + left)
-		widths.append(width)
-		
-	centers = np.array(centers)
-	widths = np.array(widths)
-		
 	return centers, widths
 
+
+#---------------------------------------------
+# Get the centers and widths of the steps in
+# many profiles at once, one profile per
+# column of y (e.g. every column of an ROI).
+# Returns the column of each strip too, in
+# order of column and then of x.
+#---------------------------------------------		
+def get_all_centers_and_widths(x, y, minThresh):
+
+	rise, fall = get_runs(np.asarray(y) >= minThresh)
+
+	cols = rise[1]
+	left = np.asarray(x)[rise[0]]
+	widths = fall[0] - rise[0]
+
+	centers = (widths / 2.0) + left
+
+	return cols, centers, widths
+
+
+#---------------------------------------------
+# Run-length encode a boolean mask along its
+# first axis.  Returns the indices where each
+# run starts and the indices just past where
+# it ends (as tuples of index arrays for a
+# 2-D mask, ordered by column)
+#---------------------------------------------		
+def get_runs(mask):
+
+	# Pad with a False on either side so every run has both
+	# a rising and a falling edge
+	padded = np.zeros((mask.shape[0]+2,) + mask.shape[1:], dtype=np.int8)
+	padded[1:-1] = mask
+	edges = np.diff(padded, axis=0)
+
+	if (mask.ndim == 1):
+		return np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+
+	# Transposed, the n-th rising edge pairs with the n-th
+	# falling edge
+	cols, rise = np.nonzero(edges.T == 1)
+	fall = np.nonzero(edges.T == -1)[1]
+	return (rise, cols), (fall, cols)
+
+
+#---------------------------------------------
+# Sub-pixel version of get_centers_and_widths.
+# y must be the raw intensity profile (not a
+# thresholded one) and minThresh the level
+# whose crossings are the strip edges.  The
+# crossing is interpolated between the pixels
+# either side of each edge, either linearly
+# or with a parabola through three pixels.
+# Also returns the errors on the centers and
+# widths, from the intensity noise (estimated
+# from the profile if not given).
+#---------------------------------------------		
+def get_subpixel_centers_and_widths(x, y, minThresh, method="linear", noise=None):
+
+	cols, centers, widths, err_centers, err_widths = get_all_subpixel_centers_and_widths(x, np.asarray(y)[:, None], minThresh, method, noise)
+
+	return centers, widths, err_centers, err_widths
+
+
+#---------------------------------------------
+# Sub-pixel version of get_all_centers_and_
+# widths, for one raw profile per column of y
+#---------------------------------------------		
+def get_all_subpixel_centers_and_widths(x, y, minThresh, method="linear", noise=None):
+
+	y = np.asarray(y, dtype=np.float64)
+	rise, fall = get_runs(y >= minThresh)
+
+	if (noise is None):
+		noise = estimate_noise(y)
+
+	# Rising edges go from below to above the threshold going
+	# down the profile, falling edges the other way around, so
+	# walk the falling edges backwards
+	rise_pos, err_rise = interpolate_edges(y, rise, 1, minThresh, method, noise)
+	fall_pos, err_fall = interpolate_edges(y, fall, -1, minThresh, method, noise)
+
+	cols = rise[1]
+	left = np.asarray(x)[rise[0]] + (rise_pos - rise[0])
+	widths = fall_pos - rise_pos
+
+	centers = (widths / 2.0) + left
+
+	err_widths = np.sqrt(err_rise**2 + err_fall**2)
+	err_centers = err_widths / 2.0
+
+	return cols, centers, widths, err_centers, err_widths
+
+
+#---------------------------------------------
+# Interpolate where the profile crosses the
+# threshold at each edge found by get_runs.
+# Positions use the same convention as the
+# integer edges: edge n is the boundary
+# between pixels n-1 and n.
+#---------------------------------------------		
+def interpolate_edges(y, edges, direction, minThresh, method, noise):
+
+	(rows, cols) = edges
+	n = y.shape[0]
+
+	# Pixel before the edge (y0, below the threshold for a rising
+	# edge), the pixel after it (y1), and the one after that (y2)
+	before = rows - 1 if direction == 1 else rows
+	after = rows if direction == 1 else rows - 1
+	beyond = after + direction
+
+	# Edges at the ends of the profile can't be interpolated;
+	# they stay on the pixel boundary, good to half a pixel
+	inside = np.logical_and(np.logical_and(before >= 0, before < n), np.logical_and(after >= 0, after < n))
+	y0 = y[np.clip(before, 0, n-1), cols]
+	y1 = y[np.clip(after, 0, n-1), cols]
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# Fraction of the way from the centre of pixel 'before' to
+		# the centre of pixel 'after' where the profile reaches the threshold
+		t = (minThresh - y0) / (y1 - y0)
+		slope = y1 - y0
+
+		if (method == "parabolic"):
+			# Parabola through before, after and beyond, solved for the
+			# root nearest to the linear one
+			usable = np.logical_and(inside, np.logical_and(beyond >= 0, beyond < n))
+			y2 = y[np.clip(beyond, 0, n-1), cols]
+			a = (y0 - 2*y1 + y2) / 2.0
+			b = y1 - y0 - a
+			c = y0 - minThresh
+			root = np.sqrt(b**2 - 4*a*c)
+			t1 = (-b + root) / (2*a)
+			t2 = (-b - root) / (2*a)
+			tp = np.where(np.abs(t1 - t) < np.abs(t2 - t), t1, t2)
+			good = usable & (np.abs(a) > 1e-9 * np.abs(b)) & (tp >= 0) & (tp <= 1)
+			t = np.where(good, tp, t)
+			slope = np.where(good, b + 2*a*t, slope)
+
+		elif (method != "linear"):
+			raise ValueError("Unknown edge interpolation method '%s'" % method)
+
+		# The edge error is the intensity noise over the slope there
+		err = noise / np.abs(slope)
+
+	ok = inside & (t >= 0) & (t <= 1)
+	pos = np.where(ok, (before + 0.5) + direction * t, rows)
+	err = np.where(ok, err, 0.5)
+
+	return pos.astype(np.float64), err
+
+
+#---------------------------------------------
+# Estimate the RMS intensity noise of raw
+# profiles from their second differences,
+# which flat regions leave close to zero.
+# Never less than the 8 bit quantization.
+#---------------------------------------------		
+def estimate_noise(y):
+	if (y.shape[0] < 3):
+		return 1.0 / np.sqrt(12.0)
+	noise = 1.4826 * np.median(np.abs(np.diff(y, n=2, axis=0))) / np.sqrt(6.0)
+	return max(noise, 1.0 / np.sqrt(12.0))
+
+
 #---------------------------------------------
 # Get a list of strips
 #---------------------------------------------		
@@ -148,131 +491,282 @@ def get_strips(x, y, minThresh, stdDev):
 	
 	
 #---------------------------------------------
-# Get the slopes of each point
+# Get the angle of the line through each point
+# (e.g. the centers of one strip across the
+# columns of the ROI), in radians
 #---------------------------------------------		
 def get_angles(x, y, std):
 	# Slope is rise over run
 	dx = np.gradient(x)
 	dy = np.gradient(y)
 	
-	a = np.tan(dy / dx)
+	a = np.arctan(dy / dx)
 
 	return a
 	
 	
 #---------------------------------------------
 # Given x and an angle, return the correct
-# y value
+# y value, i.e. with the skew taken out so a
+# strip lies along a single row
 #---------------------------------------------		
 def correct_angles(x, y, a):
-	import math
 
-	dx = np.gradient(x)
-	dy = math.atan(1) * dx
+	dy = (x - x[0]) * np.tan(a)
 	
 	y = y - dy
-	#print(y)
 
 	return y
 
 
 #---------------------------------------------
-# Draw a box on a given image
+# Correct a pitch measured down the image
+# columns for the skew angle of the strips.
+# Down a column the strips look further apart
+# than they are, by 1/cos(angle).
 #---------------------------------------------		
-def draw_ROI(img, coords, color):
-    img_box = img.copy()
-    cv2.rectangle(img_box, (coords[2], coords[0]), (coords[3], coords[1]), color, 5)
+def correct_pitch(pitch, angle, err_pitch=0.0, err_angle=0.0):
+
+	corrected = pitch * np.cos(angle)
+	err = np.sqrt((np.cos(angle) * err_pitch)**2 + (pitch * np.sin(angle) * err_angle)**2)
+
+	return corrected, err
+
+
+#---------------------------------------------
+# Estimate the strip pitch (in pixels, square
+# to the strips) and the skew angle (radians,
+# of the strips from the image rows, as
+# get_angles would give it) from the
+# 2-D Fourier transform of the ROI.
+#
+# The strips are a periodic pattern, so the
+# transform has a peak at their spatial
+# frequency.  The image is windowed to keep
+# the edges of the ROI from smearing the peak,
+# and the peak is interpolated between bins
+# from the magnitudes on either side (exact
+# for a Hann window), or without the window
+# from the complex bins (Jacobsen's
+# estimator).  The errors are the Cramer-Rao
+# bound for a frequency estimated from the
+# peak to background power ratio, scaled up
+# for the window, plus the bias of the
+# interpolation.  Without the window, the
+# edges of a real ROI can outweigh the
+# strips, so window=False is only for ROIs
+# with little beside the strips.
+#
+# Peaks above 1/minPitch cycles per pixel are
+# ignored, as noise.
+#---------------------------------------------		
+def get_pitch_and_skew(img, window=True, minPitch=3.0):
+
+	img = np.asarray(img, dtype=np.float32)
+	h, w = img.shape
+
+	img = img - img.mean()
+	if (window):
+		img = img * np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+
+	spectrum = np.fft.rfft2(img)
+	power = np.abs(spectrum)**2
+
+	# Spatial frequency of each bin, in cycles per pixel
+	ky = np.fft.fftfreq(h)[:, None]
+	kx = np.fft.rfftfreq(w)[None, :]
+	k = np.sqrt(ky**2 + kx**2)
+
+	# Leave out the DC bins, which the window leaks into,
+	# and anything too fine to be a strip
+	usable = np.logical_and(k > 1.5 / min(h, w), k <= 1.0 / minPitch)
+	search = np.where(usable, power, 0)
+	iy, ix = np.unravel_index(np.argmax(search), search.shape)
+
+	# The neighbouring bins.  Bins left of the first column of the
+	# half spectrum are the conjugates of their mirror images
+	def bin_value(y, x):
+		if (x < 0):
+			return np.conj(spectrum[-y % h, -x])
+		return spectrum[y % h, x]
+
+	def offset(lo, mid, hi, n):
+		if (window):
+			lo, mid, hi = np.abs(lo), np.abs(mid), np.abs(hi)
+			return 2 * (hi - lo) / (lo + 2*mid + hi)
+		# Jacobsen's estimator on the complex bins, with Candan's
+		# correction for a transform of n points
+		d = (2*mid - lo - hi)
+		if (d == 0):
+			return 0.0
+		return np.real((lo - hi) / d) * np.tan(np.pi / n) / (np.pi / n)
+
+	peak = power[iy, ix]
+	dy = offset(bin_value(iy-1, ix), spectrum[iy, ix], bin_value(iy+1, ix), h)
+	dx = offset(bin_value(iy, ix-1), spectrum[iy, ix], bin_value(iy, ix+1), w)
+
+	fy = (ky[iy, 0] * h + dy) / h
+	fx = (kx[0, ix] * w + dx) / w
+
+	# The frequency and its mirror image are the same pattern;
+	# pick the one pointing down the image
+	if (fy < 0 or (fy == 0 and fx < 0)):
+		fy, fx = -fy, -fx
+
+	f = np.sqrt(fy**2 + fx**2)
+	pitch = 1.0 / f
+	angle = np.arctan2(-fx, fy)
+
+	# The background is exponentially distributed, so its mean is
+	# its median over ln(2)
+	background = np.median(power[usable]) / np.log(2)
+	ratio = max(peak / background, 1.0) if background > 0 else np.inf
+	err_bin = np.sqrt(3.0) / (2 * np.pi * np.sqrt(ratio))
+	# The window widens the peak, which costs about a factor
+	# 2.3 over the bound (measured on simulated strips)
+	if (window):
+		err_bin = 2.3 * err_bin
+	# The interpolation itself is biased by other peaks leaking
+	# into the three bins (harmonics, and the mirror image of
+	# the peak).  On noise-free simulated strips that stays
+	# under 0.002 of a bin with the window.  Without it, the
+	# mirror image leaks in through the slowly decaying
+	# sidelobes, by about 0.05/(1 + 2k) of a bin for a peak
+	# k bins from zero frequency
+	def bias(k):
+		return 0.002 if window else 0.05 / (1 + 2*abs(k))
+	err_fy = np.sqrt(err_bin**2 + bias(fy * h)**2) / h
+	err_fx = np.sqrt(err_bin**2 + bias(fx * w)**2) / w
+
+	err_f = np.sqrt((fy * err_fy)**2 + (fx * err_fx)**2) / f
+	err_pitch = err_f / f**2
+	err_angle = np.sqrt((fy * err_fx)**2 + (fx * err_fy)**2) / f**2
+
+	return pitch, err_pitch, angle, err_angle
+
+
+#---------------------------------------------
+# Draw a box on a given image.  With scale > 1
+# the box is drawn on a copy shrunk by that
+# factor, which is all a preview needs, so
+# the full frame is never copied.
+#---------------------------------------------		
+def draw_ROI(img, coords, color, scale=1):
+    if (scale > 1):
+        img_box = cv2.resize(img, None, fx=1.0/scale, fy=1.0/scale, interpolation=cv2.INTER_AREA)
+        coords = [int(c / scale) for c in coords]
+    else:
+        img_box = img.copy()
+    cv2.rectangle(img_box, (coords[2], coords[0]), (coords[3], coords[1]), color, max(1, int(5 / scale)))
     return img_box
 	
 	
 #---------------------------------------------
 # Process the region of interest
+#
+# With edges="linear" or "parabolic", img must
+# be the raw (not thresholded) image and
+# minThresh the level to threshold it at,
+# e.g. the one Otsu's method picks.  The strip
+# edges are then found to a fraction of a
+# pixel, with errors from the image noise.
+#
+# img can be a tile cut out of the frame, with
+# its top left corner at origin (row, column);
+# roi and the results stay in frame pixels.
 #---------------------------------------------		
-def process_ROI(img, roi, step, offset, minThresh, stdDev):
+def process_ROI(img, roi, step, offset, minThresh, stdDev, edges=None, origin=(0, 0)):
 
 	(start, stop, left, right) = roi
-	img_p = img.copy()
 
-	fits = []
-	cols = []
-	stripcount = []
-	
-	img_p = img[start:stop, left:right]
+	img_p = img[start-origin[0]:stop-origin[0], left-origin[1]:right-origin[1]]
 
-	# Iterate the image columns, incrementing by a step size
-	for col in range(0, right-left-1, step):
-		cols.append(col)
+	# Sample every step'th column at once.  The last row
+	# and column of the ROI are left out, as they always were
+	cols = np.arange(0, right-left-1, step)
+	x = np.arange(start, stop-1)
+	profiles = img_p[:stop-start-1, 0:right-left-1:step]
+
+	if (edges is None):
+		strip_col, centers, widths = get_all_centers_and_widths(x, profiles, minThresh)
+		widths = widths.astype(np.float64)
 
-		y = np.zeros(stop-start)
-		x = np.zeros(stop-start)
-		
-		# Extract a column from the image
-		for row in range(0, stop-start-1):
-			x[row] = row + start
-			y[row] = y[row] + img_p[row][col]
-				
-		x = np.array(x)
-		y = np.array(y)
-		
-		# Fit the peaks
-		centers, widths = get_strips(x, y, minThresh, stdDev)
-		
-		# If any center registered as zero, cull it
-		z = np.where(centers > 0)
-		centers = centers[z]
-		widths = widths[z]
-		
-		# Count the strips in this row
-		stripcount.append(len(centers))
-
-		# Amplitude is meaningless, set it to the threshold value
-		amps = np.ones_like(centers) * minThresh
-		# The mean is just the center
-		means = centers
-		# This is the RMS of the peak (integral of x^2 from 0 to width divided by width)
-		# sqrt((1/3 width**3)/width) = sqrt(1/3) * width
-		devs = np.sqrt(1.0/3.0) * widths
-		
-		# There's no real error on the amplitude in this method
-		err_amps = np.ones_like(centers)
 		# Assume the strip could have been wider by 2 pixels
 		err_widths = 2.0 * np.ones_like(centers)
 		# The error on the mean is (err_width)/width
 		err_means = err_widths / widths
-		# sqrt(1/3) * err_width
-		err_devs = (np.sqrt(1.0/3.0) * err_widths) * np.ones_like(centers)
-
-		# Check that the lists are all of equal length
-		if (len(amps) and len(means) and len(devs)):
-			# Sort the results by the mean
-			a, m, s, ea, em, ed = zip(*sorted(zip(amps, means, devs, err_amps, err_means, err_devs), key=lambda pair: pair[1]))
+	else:
+		strip_col, centers, widths, err_means, err_widths = get_all_subpixel_centers_and_widths(x, profiles, minThresh, edges)
+
+	# Clean up outliers per column, which are probably dirt/scratches
+	counts = np.bincount(strip_col, minlength=len(cols))
+	mean = np.bincount(strip_col, widths, minlength=len(cols))[strip_col] / counts[strip_col]
+	std = np.sqrt(np.bincount(strip_col, (widths - mean)**2, minlength=len(cols))[strip_col] / counts[strip_col])
+	o = np.logical_and(widths <= mean + stdDev * std, widths >= mean - stdDev * std)
+
+	# If any center registered as zero, cull it
+	o = np.logical_and(o, centers > 0)
+
+	strip_col = strip_col[o]
+	centers = centers[o]
+	widths = widths[o]
+	err_widths = err_widths[o]
+	err_means = err_means[o]
+
+	# Count the strips in each column
+	stripcount = np.bincount(strip_col, minlength=len(cols))
+
+	# Amplitude is meaningless, set it to the threshold value
+	amps = np.ones_like(centers) * minThresh
+	# The mean is just the center
+	means = centers
+	# This is the RMS of the peak (integral of x^2 from 0 to width divided by width)
+	# sqrt((1/3 width**3)/width) = sqrt(1/3) * width
+	devs = np.sqrt(1.0/3.0) * widths
+
+	# There's no real error on the amplitude in this method
+	err_amps = np.ones_like(centers)
+	# sqrt(1/3) * err_width
+	err_devs = (np.sqrt(1.0/3.0) * err_widths) * np.ones_like(centers)
+
+	# Get the distances between means within each column, as
+	# np.gradient would: central differences inside, one-sided
+	# at the ends, and NaN for a column with a single strip
+	first = np.r_[True, strip_col[1:] != strip_col[:-1]] if len(strip_col) else np.zeros(0, dtype=bool)
+	last = np.r_[first[1:], True] if len(strip_col) else first
+	dd = np.full_like(means, np.nan)
+	inner = ~(first | last)
+	dd[inner] = (np.roll(means, -1)[inner] - np.roll(means, 1)[inner]) / 2.0
+	head = first & ~last
+	dd[head] = np.roll(means, -1)[head] - means[head]
+	tail = last & ~first
+	dd[tail] = means[tail] - np.roll(means, 1)[tail]
+
+	# Split the columns back apart.  Runs are already sorted by the mean
+	# within each column
+	bounds = np.r_[0, np.cumsum(stripcount)].tolist()
+	results = [v.tolist() for v in (amps, means, devs, err_amps, err_means, err_devs, dd)]
 
-			# Get the distances between means
-			dd = tuple(np.gradient(m))
+	fits = []
+	for i, col in enumerate(cols.tolist()):
+		if stripcount[i]:
+			a, m, s, ea, em, ed, d = (tuple(v[bounds[i]:bounds[i+1]]) for v in results)
+			fits.append([col, left, right, a, m, s, ea, em, ed, d])
 
-			fits.append([col, left, right, a, m, s, ea, em, ed, dd])
-			
-	return img_p, fits, min(stripcount)
+	return img_p, fits, int(stripcount.min())
 	
 
 	
 #---------------------------------------------
 # Convert a complicated data structure (a list
-# of tuples) into a standard numpy array
+# of tuples) into a float array, with the
+# missing values of short rows as NaN
 #---------------------------------------------	
 def to_array(data):
-
-	length = len(sorted(data, key=len, reverse=True)[0])
-
-	d = []
-	for di in data:
-		di_list = list(di)
-		for i in range(len(di_list), length):
-			di_list.append(None)
-
-		d.append(di_list)
-			
-	d = np.array(d)
+	length = max([len(di) for di in data] + [0])
+	d = np.full((len(data), length), np.nan)
+	for i, di in enumerate(data):
+		d[i, :len(di)] = np.asarray(di, dtype=np.float64)
 	return d
 	
 
@@ -281,10 +775,12 @@ def to_array(data):
 # string to a tuple of floats
 #---------------------------------------------	
 def parse_load_string(str):
+	# Newer numpy writes its scalars as np.float64(...)
+	str = re.sub(r"np\.float64\(([^)]*)\)", r"\1", str)
 	str = str.strip("[]") 
 	str = str.strip("()") 
 	vals = str.split(',')
-	vals = tuple([float(v) for v in vals])
+	vals = tuple([float(v) for v in vals if v.strip()])
 	return vals
 	
 
@@ -293,6 +789,10 @@ def parse_load_string(str):
 #---------------------------------------------	
 def load_results(filename, header=True):
 
+	if (filename.endswith(".npz")):
+		columns = load_columns(filename)
+		return columns["col"].astype(np.float64), ragged_to_array(columns, "means"), ragged_to_array(columns, "err_means"), ragged_to_array(columns, "dx")
+
 	import ast
 
 	x = []
@@ -332,6 +832,126 @@ def save_results(filename, results, header=None):
             writer.writerow(line)
 			
 
+#---------------------------------------------
+# Columnar results.  The fits rows of
+# process_ROI are stored as one array per
+# field: col, left and right have one entry
+# per row, and the tuples of each row are
+# concatenated into flat float arrays, with
+# row i at [offsets[i]:offsets[i+1]].
+#---------------------------------------------
+column_fields = ["amps", "means", "devs", "err_amps", "err_means", "err_devs", "dx"]
+
+
+#---------------------------------------------
+# Save results as an uncompressed .npz file,
+# so it can be memory-mapped when loaded
+#---------------------------------------------
+def save_columns(filename, results):
+
+	counts = np.array([len(row[4]) for row in results], dtype=np.int64)
+	columns = {
+		"col": np.array([row[0] for row in results], dtype=np.int64),
+		"left": np.array([row[1] for row in results], dtype=np.int64),
+		"right": np.array([row[2] for row in results], dtype=np.int64),
+		"offsets": np.r_[0, np.cumsum(counts)].astype(np.int64),
+	}
+	for i, field in enumerate(column_fields):
+		values = [v for row in results for v in row[3+i]]
+		columns[field] = np.array(values, dtype=np.float64)
+
+	# np.savez would add .npz to a name without it
+	with open(filename, "wb") as outfile:
+		np.savez(outfile, **columns)
+
+
+#---------------------------------------------
+# Load columnar results.  The arrays of an
+# uncompressed .npz are memory-mapped straight
+# from the file, so nothing is read until it
+# is used
+#---------------------------------------------
+def load_columns(filename, mmap=True):
+	import zipfile
+	import struct
+
+	columns = {}
+	with zipfile.ZipFile(filename) as archive, open(filename, "rb") as raw:
+		for info in archive.infolist():
+			name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+
+			if (not mmap or info.compress_type != zipfile.ZIP_STORED):
+				with archive.open(info) as member:
+					columns[name] = np.lib.format.read_array(member)
+				continue
+
+			# The member's data starts after its local file header
+			raw.seek(info.header_offset)
+			local = raw.read(30)
+			start = info.header_offset + 30 + sum(struct.unpack("<HH", local[26:30]))
+
+			raw.seek(start)
+			version = np.lib.format.read_magic(raw)
+			if (version == (1, 0)):
+				shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+			else:
+				shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+
+			if (np.prod(shape) == 0):
+				columns[name] = np.empty(shape, dtype=dtype)
+			else:
+				columns[name] = np.memmap(filename, dtype=dtype, mode="r", offset=raw.tell(), shape=shape, order="F" if fortran_order else "C")
+
+	return columns
+
+
+#---------------------------------------------
+# Get one row's tuple of a field back out of
+# columnar results
+#---------------------------------------------
+def get_row(columns, field, i):
+	offsets = columns["offsets"]
+	return columns[field][offsets[i]:offsets[i+1]]
+
+
+#---------------------------------------------
+# Pad a ragged field of columnar results into
+# a 2-D array, one row per fits row, with NaN
+# where a row is shorter than the longest
+#---------------------------------------------
+def ragged_to_array(columns, field):
+	offsets = np.asarray(columns["offsets"])
+	counts = np.diff(offsets)
+	rows = np.repeat(np.arange(len(counts)), counts)
+	places = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+
+	d = np.full((len(counts), counts.max() if len(counts) else 0), np.nan)
+	d[rows, places] = columns[field]
+	return d
+
+
+#---------------------------------------------
+# Convert results saved as CSV by save_results
+# into the columnar format
+#---------------------------------------------
+def convert_results(filename, outname=None, header=True):
+
+	if (outname is None):
+		outname = os.path.splitext(filename)[0] + ".npz"
+
+	results = []
+	with open(filename, mode='r', newline='') as infile:
+		reader = csv.reader(infile, delimiter=',', quotechar='"')
+		if (header):
+			next(reader, None)
+		for rows in reader:
+			if (len(rows) > 0):
+				results.append([int(float(v)) for v in rows[0:3]] + [parse_load_string(v) for v in rows[3:10]])
+
+	save_columns(outname, results)
+	return outname
+
+
 #---------------------------------------------
 # Sometimes values are None, Inf, NaN, or
 # negative.  These cause issues with plots and
@@ -339,12 +959,13 @@ def save_results(filename, results, header=None):
 #---------------------------------------------
 def fix_broken_values(vals, fixval):
     
-    y = vals.copy()
-    
-    y[list(i for i, item in enumerate(y) if item is None)] = fixval
-    y[list(i for i, item in enumerate(y) if np.isinf(item))] = fixval
-    y[list(i for i, item in enumerate(y) if np.isnan(item))] = fixval
-    y[y < 0] = fixval
+    # None becomes NaN in a float array, so one mask catches
+    # None, Inf and NaN alike
+    y = np.array(vals, dtype=np.float64)
+
+    with np.errstate(invalid='ignore'):
+        y[~(y >= 0)] = fixval
+    y[np.isinf(y)] = fixval
 
     return y
 
@@ -377,21 +998,20 @@ def calc_chisquare(expected, observed, variance, dof):
 #---------------------------------------------	
 def detect_outliers(x, y, d, order, y_max, cs_max):
 
+	x = np.asarray(x, dtype=np.float64)
+	y = np.asarray(y, dtype=np.float64)
+
 	# Anything more than y_max from the median gets a huge
 	# error associated
 	m = np.median(y)
 	out = np.logical_or(y > m + y_max, y < m - y_max)
 
-	s = d.copy()
+	s = np.array(d, dtype=np.float64)
 	s[out] = 100000.0
 
 	# numpy.polyfit() requires weights of the form 1/sigma, not
 	# 1/sigma^2
-	try:
-		sqrt_s = np.sqrt(s)
-	except:
-		print(s.dtype)
-		raise
+	sqrt_s = np.sqrt(s)
 		
 	popt = np.polyfit(x, y, order, w=1.0/sqrt_s)
 	
@@ -401,19 +1021,17 @@ def detect_outliers(x, y, d, order, y_max, cs_max):
 	# Get the chi-squared values for each point
 	cs = calc_chisquare_i(e, y, d)
 
-	try:
-		# Keep only the points where the chi-squared is
-		# less than the maximum
-		vals = np.where(cs <= cs_max)[0]
-	except:
-		vals = []
+	# Keep only the points where the chi-squared is
+	# less than the maximum
+	vals = np.where(cs <= cs_max)[0]
 		
 	return vals
 	
 
 #---------------------------------------------
-# Return the locations of n outliers.
-# Useful for culling a few rogue points.
+# Return the locations of all but the n worst
+# outliers.  Useful for culling a few rogue
+# points.
 #
 # WARNING!  Improper use of this function
 # WILL affect your results!
@@ -430,14 +1048,58 @@ def detect_n_outliers(x, y, d, order, n):
 	# Get the chi-squared values for each point
 	cs = calc_chisquare_i(e, y, d)
 
-	# Generate an array of locations
-	locs = np.array([i for i in range(len(y))])
+	# Keep everything but the n largest chi-squared values,
+	# without sorting the rest
+	keep = len(cs) - n
+	if (keep <= 0):
+		return np.zeros(0, dtype=np.intp)
+	if (n <= 0):
+		return np.arange(len(cs))
 
-	# Sort the chi-squared results
-	cs, locs = zip(*sorted(zip(cs, locs), key=lambda pair: pair[0]))
+	locs = np.argpartition(cs, keep - 1)[:keep]
 
-	locs = locs[0:len(locs)-n-1]
-	
-	locs = sorted(locs)
+	return np.sort(locs)
+
+
+#---------------------------------------------
+# Fit a polynomial, iteratively rejecting
+# points more than nsigma standard deviations
+# (from their variances d) off the fit, until
+# no more points change.  Returns the fit and
+# a mask of the points kept.
+#
+# The Vandermonde matrix is built once and
+# reused between iterations.
+#
+# WARNING!  Improper use of this function
+# WILL affect your results!
+#---------------------------------------------	
+def sigma_clip_polyfit(x, y, d, order, nsigma=3.0, max_iter=10):
+
+	x = np.asarray(x, dtype=np.float64)
+	y = np.asarray(y, dtype=np.float64)
+	d = np.asarray(d, dtype=np.float64)
+
+	# Weight each row by 1/sigma, as numpy.polyfit() does
+	w = 1.0 / np.sqrt(d)
+	A = np.vander(x, order+1) * w[:, None]
+	b = y * w
+
+	keep = np.isfinite(b) & np.all(np.isfinite(A), axis=1)
+	popt = np.full(order+1, np.nan)
+
+	for i in range(max_iter):
+		if (np.count_nonzero(keep) <= order):
+			break
+		popt = np.linalg.lstsq(A[keep], b[keep], rcond=None)[0]
+
+		# Weighted residuals are the square root of the
+		# chi-squared of each point.  Rejected points can come back
+		cs = (b - A @ popt)**2
+		new_keep = cs <= nsigma**2
+
+		if (np.array_equal(new_keep, keep)):
+			break
+		keep = new_keep
 
-	return locs
+	return popt, keep
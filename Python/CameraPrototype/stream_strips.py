@@ -0,0 +1,241 @@
+#---------------------------------------------
+# Monitors the pixel to micron conversion
+# live, from a camera or from a directory
+# that images are being saved into.
+#
+# Each frame is cropped around its center and
+# the strip pitch and skew come from a single
+# FFT (process_strips.get_pitch_and_skew).
+# Frames that arrive while one is still being
+# processed are dropped, so the estimate is
+# always of the newest frame, and a rolling
+# mean and spread over the last N frames is
+# reported with each frame's latency.
+#
+# Usage:
+#   python stream_strips.py --camera 0 [options]
+#   python stream_strips.py --watch img_dir [options]
+#---------------------------------------------
+
+import numpy as np
+import cv2
+import os
+import re
+import sys
+import time
+import argparse
+import threading
+import collections
+import configparser
+
+import process_strips as p
+
+
+#---------------------------------------------
+# Frames from a camera (or a video file), as
+# (time grabbed, frame)
+#---------------------------------------------
+def camera_frames(source=0):
+	capture = cv2.VideoCapture(source)
+	if (not capture.isOpened()):
+		raise IOError("Could not open camera %s" % source)
+	try:
+		while True:
+			ok, frame = capture.read()
+			if (not ok):
+				break
+			yield time.perf_counter(), frame
+	finally:
+		capture.release()
+
+
+#---------------------------------------------
+# Frames from images saved into a directory,
+# in the order they appear.  Stops after
+# 'idle' seconds without a new image, or
+# never if idle is None.
+#---------------------------------------------
+def directory_frames(img_dir, match_pattern=r"^.*\.(png|bmp|tif|tiff|jpg)$", poll=0.05, idle=None):
+	seen = set()
+	last = time.perf_counter()
+	while True:
+		# Hidden files are usually images still being written
+		names = [fn for fn in sorted(os.listdir(img_dir)) if fn not in seen and not fn.startswith(".") and re.search(match_pattern, fn)]
+		for fn in names:
+			frame = cv2.imread(os.path.join(img_dir, fn))
+			if frame is None:
+				# Probably still being written; try again next poll
+				continue
+			seen.add(fn)
+			last = time.perf_counter()
+			yield last, frame
+
+		if (idle is not None and time.perf_counter() - last > idle):
+			break
+		time.sleep(poll)
+
+
+#---------------------------------------------
+# Reads frames on a separate thread and keeps
+# only the newest one, counting the frames
+# that were replaced before they were used
+#---------------------------------------------
+class LatestFrame(object):
+	def __init__(self, frames):
+		self.condition = threading.Condition()
+		self.frame = None
+		self.done = False
+		self.received = 0
+		self.dropped = 0
+		self.thread = threading.Thread(target=self.read, args=(frames,), daemon=True)
+		self.thread.start()
+
+	def read(self, frames):
+		try:
+			for frame in frames:
+				with self.condition:
+					self.received = self.received + 1
+					if (self.frame is not None):
+						self.dropped = self.dropped + 1
+					self.frame = (self.received,) + tuple(frame)
+					self.condition.notify()
+		finally:
+			with self.condition:
+				self.done = True
+				self.condition.notify()
+
+	# The newest frame, as (frame number, time grabbed, frame),
+	# waiting for one if need be.  None once the frames have
+	# run out
+	def get(self):
+		with self.condition:
+			while self.frame is None and not self.done:
+				self.condition.wait()
+			frame, self.frame = self.frame, None
+			return frame
+
+
+#---------------------------------------------
+# Running mean and variance of the last n
+# values
+#---------------------------------------------
+class RollingStats(object):
+	def __init__(self, n):
+		self.values = collections.deque(maxlen=n)
+		self.total = 0.0
+		self.squares = 0.0
+
+	def add(self, value):
+		if (len(self.values) == self.values.maxlen):
+			old = self.values[0]
+			self.total = self.total - old
+			self.squares = self.squares - old**2
+		self.values.append(value)
+		self.total = self.total + value
+		self.squares = self.squares + value**2
+
+	def mean(self):
+		return self.total / len(self.values) if self.values else np.nan
+
+	def std(self):
+		n = len(self.values)
+		if (n < 2):
+			return np.nan
+		return np.sqrt(max(self.squares - self.total**2 / n, 0.0) / (n - 1))
+
+	# Error on the mean
+	def err(self):
+		return self.std() / np.sqrt(len(self.values)) if self.values else np.nan
+
+
+#---------------------------------------------
+# Crop a square of size crop from the center
+# of a frame, as a grayscale view
+#---------------------------------------------
+def center_crop(frame, crop):
+	if (frame.ndim == 3):
+		frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+	h, w = np.shape(frame)
+	size = min(crop, h, w)
+	top = int((h - size) / 2)
+	left = int((w - size) / 2)
+	return frame[top:top+size, left:left+size]
+
+
+#---------------------------------------------
+# Process frames as they come, dropping any
+# that arrive while the last one is still
+# being processed.  Yields one result per
+# processed frame:
+#   (frame number, pitch [px], err, angle
+#    [rad], err, microns/pixel, err, rolling
+#    mean microns/pixel, rolling error,
+#    latency [s], frames dropped so far)
+#---------------------------------------------
+def stream(frames, crop=1000, n=50, strip_pitch=74.5, minPitch=3.0):
+	latest = LatestFrame(frames)
+	conversion = RollingStats(n)
+
+	while True:
+		item = latest.get()
+		if item is None:
+			break
+		num, grabbed, frame = item
+
+		pitch, err_pitch, angle, err_angle = p.get_pitch_and_skew(center_crop(frame, crop), minPitch=minPitch)
+		um_per_px = strip_pitch / pitch
+		err_um_per_px = um_per_px * err_pitch / pitch
+		conversion.add(um_per_px)
+
+		yield (num, pitch, err_pitch, angle, err_angle, um_per_px, err_um_per_px,
+			conversion.mean(), conversion.err(), time.perf_counter() - grabbed, latest.dropped)
+
+
+#---------------------------------------------
+# Read PixUmConversion from a calibration
+# results file
+#---------------------------------------------
+def load_conversion(filename):
+	config = configparser.ConfigParser()
+	config.read(filename)
+	return float(config["Camera"]["PixUmConversion"])
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Monitor the pixel to micron conversion from live strip images")
+	source = parser.add_mutually_exclusive_group(required=True)
+	source.add_argument("--camera", help="camera index, or a video file")
+	source.add_argument("--watch", help="directory that images are saved into")
+	parser.add_argument("--idle", type=float, default=None, help="stop watching after this many seconds without a new image")
+	parser.add_argument("--crop", type=int, default=1000, help="size of the square cropped from the center of each frame")
+	parser.add_argument("--frames", type=int, default=50, help="number of frames in the rolling estimate")
+	parser.add_argument("--pitch-um", type=float, default=74.5, help="strip pitch in microns")
+	parser.add_argument("--min-pitch", type=float, default=3.0, help="ignore pitches finer than this many pixels")
+	parser.add_argument("--budget", type=float, default=100.0, help="latency budget per frame, in ms")
+	parser.add_argument("--calibration", help="CalibrationResults.ini to compare PixUmConversion against")
+	options = parser.parse_args()
+
+	if (options.camera is not None):
+		frames = camera_frames(int(options.camera) if options.camera.isdigit() else options.camera)
+	else:
+		frames = directory_frames(options.watch, idle=options.idle)
+
+	reference = load_conversion(options.calibration) if options.calibration else None
+
+	processed = 0
+	over = 0
+	try:
+		for (num, pitch, err_pitch, angle, err_angle, conv, err_conv, mean, err_mean, latency, dropped) in stream(frames, options.crop, options.frames, options.pitch_um, options.min_pitch):
+			processed = processed + 1
+			late = latency * 1000.0 > options.budget
+			over = over + late
+			line = "Frame %d: pitch %.3f +- %.3f px, skew %.4f +- %.4f rad, %.5f +- %.5f um/px, rolling %.5f +- %.5f um/px, %.1f ms%s, %d dropped" % (
+				num, pitch, err_pitch, angle, err_angle, conv, err_conv, mean, err_mean, latency * 1000.0, " (over budget)" if late else "", dropped)
+			if (reference is not None):
+				line = line + ", %+.5f um/px from calibration" % (mean - reference)
+			print(line)
+			sys.stdout.flush()
+	except KeyboardInterrupt:
+		pass
+
+	print("Processed %d frames, %d over the %.0f ms budget" % (processed, over, options.budget))
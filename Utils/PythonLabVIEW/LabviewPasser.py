@@ -43,17 +43,23 @@
 # -> http://zone.ni.com/reference/en-XX/help/371361P-01/lvconcepts/flattened_data/
 
 import sys
+import atexit
+import mmap
+import socket
+import traceback
+import importlib.util
 from os import devnull, remove
-from ctypes import *
+from os.path import abspath, basename, dirname, splitext
 import numpy as np
 import struct
-from collections import deque
 from binascii import hexlify
 
 labviewVersion = 16			# Set this variable to match version of labview when not
 							# calling 'getFromLabview()' (where value is auto-detected).
 suppressPrinting = True 	# Only turn to False if running print tests. MUST be
 							# TRUE for code to work
+vectorizeArrays = True		# Decode arrays of fixed-width types in one block. Only
+							# turn to False to benchmark the per-element decoders.
 
 ############################# VARIANT CLASS ##############################
 ##########################################################################
@@ -73,12 +79,58 @@ def bytesToInt(b):
 			i = (i<<8) + e
 		return i
 
+def removeQuietly(filepath):
+		try:
+			remove(filepath)
+		except OSError:
+			pass
+
 ###################### TYPENOTSUPPORTED EXCEPTION ########################
 ##########################################################################
 class TypeNotSupportedException(Exception):
 	def __init__(self, message):
 		super(TypeNotSupportedException, self).__init__(message)
 
+############################ BYTESTREAM CLASSES ##########################
+##########################################################################
+class bytestream:			# Cursor over a buffer of flattened data. Has utility methods:
+	def __init__(self, b):	# mPeek and mPop slice a memoryview, so no bytes are copied
+		self.b = memoryview(b)
+		self.i = 0			# current byte pointer
+	def mPeek(self, n=1):	# mPeek: returns the next 'n' bytes as a memoryview, but
+		return self.b[self.i:self.i+n]	#	 keeps the current byte pointer in place
+	def mPop(self, n=1):	# mPop: returns the next 'n' bytes as a memoryview,
+		self.i += n			#	 moving the current byte pointer forward by 'n'
+		return self.b[self.i-n:self.i]
+	def nPeek(self, n=1):	# nPeek: same as mPeek, but returns the data as an int
+		return bytesToInt(self.mPeek(n))
+	def nPop(self, n=1):	# nPop: same as mPop, but returns the data as an int
+		return bytesToInt(self.mPop(n))
+	def close(self):		# close: called at end of 'getFromLabview()'
+		return				#	 closes and deletes any temp files, if used.
+
+class bytestreamFromHexString(bytestream):	# Subclass used when data is passed
+	def __init__(self, s):					#	 as a hex string through cmd
+		bytestream.__init__(self, bytearray.fromhex(s))
+
+class bytestreamFromBinFile(bytestream):	# Subclass used when data is passed through a *.bin
+	def __init__(self, filepath):			#	 file. The file is memory-mapped (copy-on-write),
+		self.filepath = filepath			#	 so decoded arrays are views of it, not copies.
+		self.f = open(self.filepath, "rb")
+		self.m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_COPY)
+		bytestream.__init__(self, self.m)
+	def close(self):
+		self.b.release()
+		try:
+			self.m.close()
+		except BufferError:	# decoded arrays still view the map. It is
+			pass			# unmapped once they are garbage collected.
+		self.f.close()
+		try:
+			remove(self.filepath)
+		except OSError:		# Windows can't delete a file that is still mapped
+			atexit.register(removeQuietly, self.filepath)
+
 ######################################## GETFROMLABVIEW() ########################################
 ##################################################################################################
 # This method is used to pass data from LabVIEW to Python. It collects the flattend LabVIEW
@@ -88,202 +140,222 @@ def getFromLabview():
 		sys.stdout = open(devnull, 'w')	# Disable printing until last line of 'sendToLabview()'. Any
 										# unexpected print statements will interfere data passing.
 
-	############################ 'GLOBAL' CLASSES# ###########################
-	##########################################################################
-	class bytestream:		# Superclass for data type of 'data'. Has utility methods:
-		def mPeek(self, n):		# mPeek: returns the next 'n' bytes as a bytearray, but
-			return				#	 keeps the current byte pointer in place 
-		def mPop(self, n):		# mPop: returns the next 'n' bytes as a bytearray,
-			return				#	 placign moving the current byte pointer forward by 'n'
-		def nPeek(self, n):		# nPeek: same as mPeek, but returns the data as an int
-			return bytesToInt(self.mPeek(n))
-		def nPop(self, n):		# nPop: same as mPop, but returns the data as an int
-			return bytesToInt(self.mPop(n))
-		def close(self):		# close: called at end of 'getFromLabview()'
-			return				#	 closes and deletes any temp files, if used.
-
-	class bytestreamFromHexString(bytestream):	# Subclass used when data is passed
-		def __init__(self, s):					#	 as a hex string through cmd
-			self.b = deque(bytearray.fromhex(s))# Wraps a HexString as a bytesream
-		def mPeek(self, n):
-			return bytearray(map(lambda x: self.b[x], range(n)))
-		def mPop(self, n):
-			return bytearray(map(lambda __: self.b.popleft(), range(n)))
-
-	class bytetreamFromBinFile(bytestream):		# Subclass used when data is passed
-		def __init__(self, filepath):			#	 through a *.bin file
-			self.filepath = filepath			# Wraps a *.bin file as a bytestream
-			self.f = open(self.filepath, "rb")
-		def mPeek(self, n):
-			d = self.mPop(n)
-			self.f.seek(-n, 1)
-			return d
-		def mPop(self, n):
-			d = self.f.read(n)
-			try:
-				d = d.encode()
-			except:
-				pass
-			return bytearray(d)
-		def close(self):
-			self.f.close()
-			return remove(self.filepath)
-
-	########################### 'GLOBAL' CONSTANTS ###########################
-	##########################################################################
 	data = bytestreamFromBinFile((sys.argv[1])[3:]) if (sys.argv[1])[:3] == 'bin' else bytestreamFromHexString(sys.argv[1])
-						# 'data' acts as a global variable throughout unflattening.
-
-	labviewVersion = int(hexlify(data.mPeek(2)))/100
-
-	methodLookup = {	# converts typecodes to a type-specific parser to call
-		0x00	:	"parseNone",
-		0x01	:	"parseInt8",
-		0x02	:	"parseInt16",
-		0x03	:	"parseInt32",
-		0x04	:	"parseInt64",
-		0x05	:	"parseUInt8",
-		0x06	:	"parseUInt16",
-		0x07	:	"parseUInt32",
-		0x08	:	"parseUInt64",
-		0x09	:	"parseFloat32",
-		0x0A	:	"parseFloat64",
-		0x0C	:	"parseComplex64",
-		0x0D	:	"parseComplex128",
-		0x15	:	"parseInt8",
-		0x16	:	"parseInt16",
-		0x17	:	"parseInt32",
-		0x19	:	"parseFloat32",
-		0x1A	:	"parseFloat64",
-		0x1C	:	"parseComplex64",
-		0x1D	:	"parseComplex128",
-		0x21	:	"parseBool",
-		0x30	:	"parseStr",
-		0x32	:	"parsePath",
-		0x40	: 	"parseArray",
-		0x50	: 	"parseCluster",
-		0x53	:	"parseVariant"
-	}
-
-	############################# VARIANT PARSER #############################
-	##########################################################################
-	def variantParser():	# As all passed data is contained within a variant,
-							# all other type-specific parsers are contained within.
-
-		descriptors = []	# List of type descriptors
-							# Includes all types found inside this variant
-
-		######################### TYPE-SPECIFIC PARSERS ##########################
-		##########################################################################
-		def parseNone(__):
-			return None
-
-		def parseInt8(__):
-			return np.int8(c_char(data.nPop()))
-
-		def parseInt16(__):
-			return np.int16(c_short(data.nPop(2)))
-
-		def parseInt32(__):
-			return np.int32(c_long(data.nPop(4)))
-
-		def parseInt64(__):
-			return np.int64(c_longlong(data.nPop(8)))
-
-		def parseUInt8(__):
-			return np.uint8(c_uchar(data.nPop()))
-
-		def parseUInt16(__):
-			return np.uint16(c_ushort(data.nPop(2)))
-
-		def parseUInt32(__):
-			return np.uint32(c_uint32(data.nPop(4)))
-
-		def parseUInt64(__):
-			return np.uint64(c_ulonglong(data.nPop(8)))
-
-		def parseFloat32(__):
-			return np.float32(cast(pointer(c_int32(data.nPop(4))), POINTER(c_float)).contents)
-
-		def parseFloat64(__):
-			return np.float64(cast(pointer(c_longlong(data.nPop(8))), POINTER(c_double)).contents)
-
-		def parseComplex64(__):
-			return np.complex64(parseFloat32(__) + parseFloat32(__)*1j)
-
-		def parseComplex128(__):
-			return np.complex128(parseFloat64(__) + parseFloat64(__)*1j)
+	v = unflatten(data)
+	data.close()
+	return v
 
-		def parseBool(__):
-			return bool(data.nPop())
 
-		def parseStr(__):
-			return str(mPop(data.nPop(4)).decode())
+########################################## UNFLATTEN(data) #######################################
+##################################################################################################
+# This method decodes one flattened LabVIEW variant from the bytestream 'data', and returns the
+# equivalent data structure in Python. It is shared by 'getFromLabview()' and 'serve()'.
+def unflatten(data):
+	return decodeVariant(data).data
 
-		def parsePath(index):
+############################### DECODER PLANS ############################
+##########################################################################
+# Each table of type descriptors is compiled once into a decoder plan: a function of the
+# bytestream that returns the decoded value. Plans are cached by the bytes of the descriptor
+# table, so a layout LabVIEW sends repeatedly (e.g. [path, [guessC, guessR]]) is only compiled
+# on its first call. Fixed-width scalars, and clusters made only of them, decode with a single
+# precomputed 'struct' format; arrays of them with a single 'np.frombuffer'.
+planCache = {}
+
+scalarLookup = {	# converts fixed-width typecodes to a struct format and python/numpy type
+	0x01	:	("b", np.int8),
+	0x02	:	("h", np.int16),
+	0x03	:	("l", np.int32),
+	0x04	:	("q", np.int64),
+	0x05	:	("B", np.uint8),
+	0x06	:	("H", np.uint16),
+	0x07	:	("L", np.uint32),
+	0x08	:	("Q", np.uint64),
+	0x09	:	("f", np.float32),
+	0x0A	:	("d", np.float64),
+	0x0C	:	("ff", np.complex64),
+	0x0D	:	("dd", np.complex128),
+	0x15	:	("B", np.uint8),	# enums are unsigned
+	0x16	:	("H", np.uint16),
+	0x17	:	("L", np.uint32),
+	0x19	:	("f", np.float32),
+	0x1A	:	("d", np.float64),
+	0x1C	:	("ff", np.complex64),
+	0x1D	:	("dd", np.complex128),
+	0x21	:	("?", bool)
+}
+
+dtypeLookup = {		# converts struct formats to the equivalent big-endian numpy dtype
+	"b"		:	">i1",
+	"h"		:	">i2",
+	"l"		:	">i4",
+	"q"		:	">i8",
+	"B"		:	">u1",
+	"H"		:	">u2",
+	"L"		:	">u4",
+	"Q"		:	">u8",
+	"f"		:	">f4",
+	"d"		:	">f8",
+	"ff"	:	">c8",
+	"dd"	:	">c16",
+	"?"		:	"?"
+}
+
+def decodeVariant(data):	# Decodes a variant, either the outermost one or one nested inside it
+	data.mPop(4)
+	start = data.i
+	count = data.nPeek(4)
+	if count > (len(data.b) - data.i - 4) // 4:	# every descriptor takes at least 4 bytes, so a garbled or
+		raise ValueError("Variant claims %d type descriptors, more than the message holds" % count)	# truncated count fails here
+	descriptors = tuple(map(lambda __: data.mPop(data.nPeek(2)), range(data.nPop(4))))	# determines the number of types, then pops each
+	data.mPop(2)																# type into  descriptors, according to its length.
+	key = bytes(data.b[start:data.i+2])		# descriptor table and index of the top-level type
+	plan = planCache.get(key)
+	if plan is None:
+		plan = planCache[key] = compilePlan(tuple(map(bytes, descriptors)), data.nPeek(2))
+	data.mPop(2)
+	temp = plan(data)
+	data.mPop(4)
+	return variant(temp)
+
+def compilePlan(descriptors, index):	# Returns the decoder for 'descriptors[index]'
+
+	decoders = {}	# decoders already compiled, by descriptor index
+
+	def typecode(index):
+		return descriptors[index][3]
+
+	def layout(index):		# Returns the struct format and value builder of a fixed-width type,
+		t = typecode(index)	# or None. Builders take an iterator over the unpacked values.
+		if t in scalarLookup:
+			fmt, pytype = scalarLookup[t]
+			if len(fmt) == 2:
+				return fmt, lambda it: pytype(complex(next(it), next(it)))
+			return fmt, lambda it: pytype(next(it))
+		if t == 0x50:
+			d = descriptors[index]
+			elements = list(map(lambda x: layout(bytesToInt(d[6+2*x:8+2*x])), range(bytesToInt(d[4:6]))))
+			if None in elements:
+				return None
+			builders = [b for __, b in elements]
+			return ''.join(f for f, __ in elements), lambda it: [b(it) for b in builders]
+		return None
+
+	def compileFixed(fmt, build):
+		s = struct.Struct(">" + fmt)
+		def decode(data):
+			return build(iter(s.unpack_from(data.mPop(s.size))))
+		return decode
+
+	def compileNone(index):
+		return lambda __: None
+
+	def compileStr(index):
+		return lambda data: str(bytes(data.mPop(data.nPop(4))).decode())
+
+	def compilePath(index):
+		def decode(data):
 			data.mPop(4)
 			l = data.nPop(4)
 			data.mPop(4)
 			d = chr(data.mPop(3)[1])
-			p = data.mPop(l-7)
-			dot = False
+			p = bytearray(data.mPop(l-7))
 			for i in range(len(p)):
 				if (p[i]>>4) < 2:
 					p[i] = 0x5C
 			if not 0x2E in p:
 				p.append(0x5C)
 			return d + ':\\' + ''.join(map(chr, p))
-
-		def parseArray(index):
-			descriptor = descriptors[index]
-			n = bytesToInt(descriptor[4:6])		# number of dimensions
-			dims = tuple(map(lambda x: data.nPop(4), range(n)))
-			elementD = bytesToInt(descriptor[-2:])
-			if bytesToInt((descriptors[elementD])[3:4]) == 0x50:# if array of type 'cluster': Special Case
-				a = np.empty(dims, dtype=object)				# case stops numpy from automatically
-				for c, __ in np.ndenumerate(a):					# casting interior lists to numpy.arrays
-					a[c] = parseCluster(elementD)				# by explicitly stating dtype=object
+		return decode
+
+	def compileArray(index):
+		d = descriptors[index]
+		n = bytesToInt(d[4:6])		# number of dimensions
+		dimsFormat = struct.Struct(">%dL" % n)
+		elementD = bytesToInt(d[-2:])
+		decodeElement = compile(elementD)
+		elementLayout = layout(elementD)
+		isCluster = typecode(elementD) == 0x50
+		elementType = str if typecode(elementD) in (0x30, 0x32) else None	# keeps empty string arrays strings
+		if elementLayout is not None:
+			fmt, build = elementLayout
+			dtype = np.dtype([("f%d" % i, dtypeLookup[f]) for i, f in enumerate(fmt)] if isCluster else dtypeLookup[fmt])
+		def decode(data):
+			dims = dimsFormat.unpack_from(data.mPop(dimsFormat.size))
+			count = int(np.prod(dims))
+			if vectorizeArrays and elementLayout is not None:		# if array of fixed-width elements: reads
+				block = np.frombuffer(data.mPop(count*dtype.itemsize), dtype=dtype)	# the whole block at once,
+				if not isCluster:									# instead of parsing element by element
+					return block.reshape(dims)
+				a = np.empty(dims, dtype=object)
+				for c, record in zip(np.ndindex(*dims), block.tolist()):
+					a[c] = build(iter(record))
 				return a
-			return np.array(np.reshape(list(map(lambda __: parser(elementD), range(np.prod(dims)))), dims))
-
-		def parseCluster(index):
-			descriptor = descriptors[index]
-			return list(map(lambda x: parser(bytesToInt(descriptor[6+2*x:8+2*x])), range(bytesToInt(descriptor[4:6]))))
-
-		def parseVariant(__):		# wrapper method to recursively call 'variantParser'. Useful in that
-			return variantParser()	# it appears on same level of heirarchy as other type-specific parsers
+			if isCluster:							# if array of type 'cluster': Special Case
+				a = np.empty(dims, dtype=object)	# case stops numpy from automatically
+				for c in np.ndindex(*dims):			# casting interior lists to numpy.arrays
+					a[c] = decodeElement(data)		# by explicitly stating dtype=object
+				return a
+			return np.array(list(map(lambda __: decodeElement(data), range(count))), dtype=elementType).reshape(dims)
+		return decode
+
+	def compileCluster(index):
+		d = descriptors[index]
+		elements = list(map(lambda x: compile(bytesToInt(d[6+2*x:8+2*x])), range(bytesToInt(d[4:6]))))
+		return lambda data: [e(data) for e in elements]
+
+	def compileVariant(index):
+		return decodeVariant
+
+	def raiseException(index):
+		raise TypeNotSupportedException("Labview type 0x" + descriptors[index][3:4].hex().upper() + " is not supported by this version of LabViewPasser.")
+
+	compileLookup = {	# converts typecodes to a type-specific compiler to call
+		0x00	:	compileNone,
+		0x30	:	compileStr,
+		0x32	:	compilePath,
+		0x40	: 	compileArray,
+		0x50	: 	compileCluster,
+		0x53	:	compileVariant
+	}
 
-		def raiseException(index):
-			raise TypeNotSupportedException("Labview type 0x" + (descriptors[index])[3:4].hex().upper() + " is not supported by this version of LabViewPasser.")
+	def compile(index):
+		if index not in decoders:
+			fixed = layout(index)
+			if fixed is not None:
+				decoders[index] = compileFixed(*fixed)
+			else:
+				decoders[index] = compileLookup.get(typecode(index), raiseException)(index)
+		return decoders[index]
 
-		############################ GENERIC PARSER ##############################
-		##########################################################################
-		variantLocals = locals()	# captures 'locals()' in the parseVariant scope, for use in
-									# evaluating strings into type-specific parser method names.
-		def parser(index):
-			return eval(methodLookup.get(bytesToInt((descriptors[index])[3:4]), "raiseException"), variantLocals)(index)	# calls appropriate type-specific parser
-		
-		# - - - - - - - - - continuation of 'variantParser()' - - - - - - - - -  #
-		data.mPop(4)
-		descriptors = tuple(map(lambda __: data.mPop(data.nPeek(2)), range(data.nPop(4))))	# determines the number of types, then pops each
-		data.mPop(2)																# type into  descriptors, according to its length.
-		temp = parser(data.nPop(2))
-		data.mPop(4)
-		return variant(temp)
-
-	v = variantParser().data
-	data.close()
-	return v
+	return compile(index)
 
 
 ################################### SENDTOLABVIEW(dataToSend) ####################################
 ##################################################################################################
 # This method passes data from Python to LabVIEW. It wraps the Python data from 'dataToSend'
-# in a variant and encodes it in LabVIEW's flattened string data format. The result is printed.
-def sendToLabview(dataToSend):
+# in a variant and encodes it in LabVIEW's flattened data format. By default the result is
+# printed as a hex string. If 'binFile' is given, the raw bytes are written to that *.bin file
+# instead and 'bin' + binFile is printed, mirroring the *.bin input mode of 'getFromLabview()'.
+def sendToLabview(dataToSend, binFile=None):
 	if dataToSend is None and len(sys.argv) <= 1:
 		return
 
+	flattened = flatten(dataToSend)
+	sys.stdout = sys.__stdout__	# re-enable printing
+	if binFile is not None:
+		with open(binFile, "wb") as f:
+			f.write(flattened)
+		sys.stdout.write("bin" + binFile + "\n")
+	else:
+		sys.stdout.write(hexlify(flattened).decode() + "\n")
+
+
+####################################### FLATTEN(dataToSend) ######################################
+##################################################################################################
+# This method wraps the Python data from 'dataToSend' in a variant, and returns it encoded in
+# LabVIEW's flattened data format as a bytearray. It is shared by 'sendToLabview()' and 'serve()'.
+def flatten(dataToSend):
 	methodLookup = {	# converts typecodes to a specific exporter to call
 		"NoneType"		:	"exportNone",
 		"int8"			:	"exportInt8",
@@ -304,12 +376,29 @@ def sendToLabview(dataToSend):
 		"float"			:	"exportFloat64",
 		"complex"		:	"exportComplex128",
 		"str"			:	"exportString",
+		"str_"			:	"exportString",
 		"ndarray"		:	"exportArray",
 		"list"			:	"exportCluster",
 		"object"		:	"exportVariant",
 		"variant"		:	"exportVariant"
 	}
 
+	dtypeLookup = {		# converts numpy dtype names to the big-endian dtype used to
+		"int8"			:	">i1",	# write whole arrays of that type in a single step
+		"int16"			:	">i2",
+		"int32"			:	">i4",
+		"int64"			:	">i8",
+		"uint8"			:	">u1",
+		"uint16"		:	">u2",
+		"uint32"		:	">u4",
+		"uint64"		:	">u8",
+		"float32"		:	">f4",
+		"float64"		:	">f8",
+		"complex64"		:	">c8",
+		"complex128"	:	">c16",
+		"bool"			:	"?"
+	}
+
 	############################ VARIANT EXPORTER ############################
 	##########################################################################
 	def variantExporter(v):	# As all passed data is enclosed inside a variant,
@@ -317,71 +406,96 @@ def sendToLabview(dataToSend):
 
 		descriptors = []	# List of type descriptors
 							# Includes all types found inside this variant
+		flat = bytearray()	# Flattened data. Each type-specific exporter appends its data
+							# here, and returns its type descriptor (None if suppressed).
 
 		######################## TYPE-SPECIFIC EXPORTERS #########################
 		##########################################################################
-		def exportNone(__, suppressDescriptors=False):
-			return None if suppressDescriptors else "00040000", ""
+		def exportNone(__=None, suppressDescriptors=False):
+			return None if suppressDescriptors else b"\x00\x04\x00\x00"
 
 		def exportInt8(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000100", ("%x" % struct.unpack("=B", struct.pack("=b", num))[0]).zfill(2)
+			flat.extend(struct.pack(">b", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x01\x00"
 
 		def exportInt16(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000200", ("%x" % struct.unpack("=H", struct.pack("=h", num))[0]).zfill(4)
+			flat.extend(struct.pack(">h", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x02\x00"
 
 		def exportInt32(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000300", ("%x" % struct.unpack("=L", struct.pack("=l", num))[0]).zfill(8)
+			flat.extend(struct.pack(">l", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x03\x00"
 
 		def exportInt64(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000400", ("%x" % struct.unpack("=Q", struct.pack("=q", num))[0]).zfill(16)
+			flat.extend(struct.pack(">q", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x04\x00"
 
 		def exportUInt8(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000500", ("%x" % num).zfill(2)
+			flat.extend(struct.pack(">B", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x05\x00"
 
 		def exportUInt16(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000600", ("%x" % num).zfill(4)
+			flat.extend(struct.pack(">H", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x06\x00"
 
 		def exportUInt32(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000700", ("%x" % num).zfill(8)
+			flat.extend(struct.pack(">L", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x07\x00"
 
 		def exportUInt64(num=0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000800", ("%x" % num).zfill(16)
+			flat.extend(struct.pack(">Q", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x08\x00"
 
 		def exportFloat32(num=0.0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000900", ("%x" % struct.unpack("=L", struct.pack("=f", num))[0]).zfill(8)
+			flat.extend(struct.pack(">f", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x09\x00"
 
 		def exportFloat64(num=0.0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000a00", ("%x" % struct.unpack("=Q", struct.pack("=d", num))[0]).zfill(16)
+			flat.extend(struct.pack(">d", num))
+			return None if suppressDescriptors else b"\x00\x05\x00\x0a\x00"
 
 		def exportComplex64(num=0.0, suppressDescriptors=False):
-			return None if suppressDescriptors else "0005000c00", ("%x" % struct.unpack("=Q", struct.pack("=ff", num.imag, num.real))[0]).zfill(16)
+			flat.extend(struct.pack(">ff", num.real, num.imag))
+			return None if suppressDescriptors else b"\x00\x05\x00\x0c\x00"
 
 		def exportComplex128(num=0.0, suppressDescriptors=False):
-			s = struct.unpack("=QQ", struct.pack("=dd", num.real, num.imag))
-			return None if suppressDescriptors else "0005000d00", ("%x" % s[0]).zfill(16) + ("%x" % s[1]).zfill(16)
-			
+			flat.extend(struct.pack(">dd", num.real, num.imag))
+			return None if suppressDescriptors else b"\x00\x05\x00\x0d\x00"
+
 		def exportBoolean(b=False, suppressDescriptors=False):
-			return None if suppressDescriptors else "00040021", ("%x" % struct.unpack("=B", struct.pack("=?", b))[0]).zfill(2)
+			flat.extend(struct.pack(">?", b))
+			return None if suppressDescriptors else b"\x00\x04\x00\x21"
 
 		def exportString(s='', suppressDescriptors=False):
-			return None if suppressDescriptors else "00080030ffffffff", exportInt32(len(s))[1] + hexlify(bytearray(s, 'ascii')).decode()
+			b = bytearray(s, 'ascii')
+			flat.extend(struct.pack(">l", len(b)))
+			flat.extend(b)
+			return None if suppressDescriptors else b"\x00\x08\x00\x30\xff\xff\xff\xff"
 
 		def exportArray(a=np.empty((0,), dtype=np.float64), suppressDescriptors=False):
-			dims = a.shape
-			n = len(dims)
-			flat = a.flat	# returns an iterator that iterates over a 1-dimensional version of 'a'
-			dimData = ''.join(list(map(lambda i: exportInt32(dims[i], True)[1], range(len(dims)))))	# converts 'dims' to a string
-			if a.size > 0:
-				elementD, data0 = export((flat[0]), suppressDescriptors)	# collects type-descriptor from first element, while simultaneously populating the first spot in the flattend data.
-				return None if suppressDescriptors else exportUInt16(8+4*n, True)[1] + '0040' + exportUInt16(n, True)[1] + 'f'*8*n + elementD, dimData + data0 + ''.join(list(map(lambda e: export(e, True)[1], flat[1:])))
-			return None if suppressDescriptors else exportUInt16(8+4*n, True)[1] + '0040' + exportUInt16(n, True)[1] + 'f'*8*n + export(dtype=a.dtype)[0], dimData # uses 'a.dtype' to get type descriptor if 'a' is empty
+			n = a.ndim
+			flat.extend(struct.pack(">%dl" % n, *a.shape))
+			if a.dtype.name in dtypeLookup or a.size == 0:	# uses 'a.dtype' to get the element type descriptor. The data
+				mark = len(flat)							# written for the default-valued element is discarded, and
+				elementD = export(suppressDescriptors=suppressDescriptors, dtype=a.dtype)	# numeric arrays are
+				del flat[mark:]								# then written as one big-endian block
+				if a.size > 0:
+					flat.extend(np.ascontiguousarray(a, dtype=dtypeLookup[a.dtype.name]).tobytes())
+			else:
+				flatIter = a.flat	# returns an iterator that iterates over a 1-dimensional version of 'a'
+				elementD = export(next(flatIter), suppressDescriptors)	# collects type-descriptor from first element
+				for e in flatIter:
+					export(e, True)
+			return None if suppressDescriptors else struct.pack(">HHH", 8+4*n, 0x0040, n) + b"\xff"*4*n + elementD
 
 		def exportCluster(c=[], suppressDescriptors=False):
-			temp = list(zip(*list(map(lambda e: list(export(e, suppressDescriptors)), c))))
-			return None if suppressDescriptors else exportUInt16(6+2*len(c), True)[1] + '0050' + exportUInt16(len(c), True)[1] + ''.join(temp[0]), ''.join(temp[1])
+			elementDs = list(map(lambda e: export(e, suppressDescriptors), c))
+			return None if suppressDescriptors else struct.pack(">HHH", 6+2*len(c), 0x0050, len(c)) + b''.join(elementDs)
 
-		def exportVariant(v=None, suppressDescriptors=False):					# wrapper method to recursively call 'variantExporter'. Useful in that it appears
-			return None if suppressDescriptors else "00040053", variantExporter(v) if v else None	# on same level of heirarchy as other type-specific exporters
+		def exportVariant(v=None, suppressDescriptors=False):	# wrapper method to recursively call 'variantExporter'. Useful in that it
+			if v:												# appears on same level of heirarchy as other type-specific exporters
+				flat.extend(variantExporter(v))
+			return None if suppressDescriptors else b"\x00\x04\x00\x53"
 
 		def raiseException(data, __):
 			raise TypeNotSupportedException("Python type " + str(data.__class__.__name__) + " is not supported by LabVIEW. (see VI help file for list of supported types)")
@@ -391,11 +505,10 @@ def sendToLabview(dataToSend):
 		variantLocals = locals()	# captures 'locals()' in the parseVariant scope, for use in
 									# evaluating strings into type-specific exporter method names.
 		def export(data=None, suppressDescriptors=False, dtype=None):
-			descriptor, hexData = '', ''
 			if dtype is None:
-				descriptor, hexData = eval(methodLookup.get(data.__class__.__name__, "raiseException"), variantLocals)(data, suppressDescriptors)	
-			else:																												# calls appropriate type-specific exproter
-				descriptor, hexData = eval(methodLookup.get(str(dtype), "raiseException"), variantLocals)(suppressDescriptors=suppressDescriptors)
+				descriptor = eval(methodLookup.get(data.__class__.__name__, "raiseException"), variantLocals)(data, suppressDescriptors)
+			else:																							# calls appropriate type-specific exproter
+				descriptor = eval(methodLookup.get(dtype.name, methodLookup.get(dtype.type.__name__, "raiseException")), variantLocals)(suppressDescriptors=suppressDescriptors)
 
 			if not suppressDescriptors:
 				dNum = 0
@@ -404,12 +517,115 @@ def sendToLabview(dataToSend):
 				except ValueError:							# If not found, adds type descriptor
 					descriptors.append(descriptor)			# to the end of the list, and returns
 					dNum = len(descriptors)-1				# the final index of the list.
-				descriptor = exportUInt16(dNum, True)[1]
-			return descriptor, hexData
+				descriptor = struct.pack(">H", dNum)
+			return descriptor
 
 		#  - - - - - - - - continuation of 'variantExporter(v)' - - - - - - - -  #
-		descriptor, hexData = export(v.data)
-		return str(labviewVersion*100) + "8000" + exportUInt32(len(descriptors))[1] + ''.join(descriptors) + "0001" + descriptor + hexData + "00000000"
+		descriptor = export(v.data)
+		out = bytearray.fromhex(str(labviewVersion*100) + "8000")
+		out.extend(struct.pack(">L", len(descriptors)))
+		for d in descriptors:
+			out.extend(d)
+		out.extend(b"\x00\x01" + descriptor)
+		out.extend(flat)
+		out.extend(b"\x00\x00\x00\x00")
+		return out
 
-	sys.stdout = sys.__stdout__	# re-enable printing
-	sys.stdout.write(variantExporter(variant(dataToSend)) + "\n")
+	return variantExporter(variant(dataToSend))
+
+
+######################################### WORKER SERVER ##########################################
+##################################################################################################
+# Instead of starting a new Python process for every call, LabVIEW can keep one worker running:
+# 	python LabviewPasser.py serve [port] [script.py ...]
+# Each script is imported once, and registers its handlers with '@register(name)'. LabVIEW then
+# connects to localhost:port with the TCP VIs. Every message, in both directions, is a flattened
+# variant preceded by its length as a big-endian U32 (as written by 'Flatten To String').
+# 	request: cluster of [handler name, args]	->	handler(args) is called
+# 	reply:   cluster of [return code, standard error, data out], mirroring PythonWrapper.vi
+# The request name "stop" closes the worker.
+handlers = {}			# registered handler functions, by name
+defaultPort = 6340
+
+class LabviewExit(Exception):					# Raised by a handler to send 'data' back with a
+	def __init__(self, code, data=None):		# non-zero return code. Equivalent to calling
+		super(LabviewExit, self).__init__(code)	# 'sendToLabview(data)' then 'exit(code)'.
+		self.code = code
+		self.data = data
+
+def register(name):		# Decorator that registers a handler under 'name'
+	def decorator(handler):
+		handlers[name] = handler
+		return handler
+	return decorator
+
+def runFromLabview(handler):	# Runs 'handler' once on the arguments passed by PythonWrapper.vi.
+	try:						# Scripts call this under "if __name__ == '__main__':", so they
+		sendToLabview(handler(getFromLabview()))	# also work as one-shot scripts.
+	except LabviewExit as e:
+		sendToLabview(e.data)
+		sys.exit(e.code)
+
+def recvExactly(conn, n):	# Reads exactly 'n' bytes from 'conn' into a bytearray.
+	b = bytearray(n)		# Returns None if the connection is closed first.
+	view = memoryview(b)
+	while view:
+		k = conn.recv_into(view)
+		if k == 0:
+			return None
+		view = view[k:]
+	return b
+
+def dispatch(request):
+	try:
+		name, args = request
+		try:
+			reply = [0, '', handlers[name](args)]
+		except LabviewExit as e:
+			reply = [e.code, '', e.data]
+		return flatten(reply)
+	except Exception:
+		return flatten([1, traceback.format_exc(), None])
+
+def serve(port=defaultPort):
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server.bind(("127.0.0.1", port))	# local connections only
+	server.listen(1)
+	running = True
+	while running:
+		conn, __ = server.accept()
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		while running:
+			size = recvExactly(conn, 4)
+			if size is None:			# LabVIEW closed the connection
+				break
+			message = recvExactly(conn, bytesToInt(size))
+			if message is None:
+				break
+			try:
+				request = unflatten(bytestream(message))
+			except Exception:	# an unsupported type or a garbled message fails this call, not the worker
+				reply = flatten([1, traceback.format_exc(), None])
+			else:
+				running = not (isinstance(request, list) and request[:1] == ["stop"])
+				reply = dispatch(request) if running else flatten([0, '', None])
+			conn.sendall(struct.pack(">L", len(reply)) + reply)
+		conn.close()
+	server.close()
+
+def loadScript(path):	# Imports a handler script by file path, without running its '__main__' block.
+	name = splitext(basename(path))[0]	# The script is importable by name afterwards, so
+	sys.path.insert(0, dirname(abspath(path)))	# handlers can use process pools.
+	spec = importlib.util.spec_from_file_location(name, path)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	spec.loader.exec_module(module)
+	return module
+
+if __name__ == "__main__" and sys.argv[1:2] == ["serve"]:
+	sys.path.insert(0, dirname(dirname(abspath(__file__))))	# the Utils directory, so this works from anywhere
+	from PythonLabVIEW import LabviewPasser	# the module the handler scripts import, and register with
+	for script in sys.argv[3:]:
+		LabviewPasser.loadScript(script)
+	LabviewPasser.serve(int(sys.argv[2]) if len(sys.argv) > 2 else defaultPort)
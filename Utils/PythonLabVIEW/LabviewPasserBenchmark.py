@@ -0,0 +1,330 @@
+#
+# ---------- LabviewPasser Benchmark ----------
+#
+# Measures and checks LabviewPasser without LabVIEW.
+# All flattened variants are built in Python.
+#
+# USAGE:
+# 	python LabviewPasserBenchmark.py suite [--output FILE] [--fuzz N] [--seed S]
+# 		Times 'sendToLabview()'/'getFromLabview()' for every supported
+# 		LabVIEW type code, through both the hex and the *.bin transports,
+# 		checks that every payload round-trips exactly, and fuzzes N random
+# 		nested structures. Results are written to FILE as JSON.
+# 	python LabviewPasserBenchmark.py compare [size]
+# 		Compares the vectorized and per-element decoding of a square
+# 		float64 array (default 2048x2048).
+#
+
+import sys
+import io
+import os
+import json
+import struct
+import string
+import tempfile
+import platform
+import argparse
+import time
+import numpy as np
+import LabviewPasser as lv
+
+############################ PAYLOAD BUILDERS ############################
+##########################################################################
+def flattenFloat64Array(a):		# Builds the hex string LabVIEW would pass for
+	n = a.ndim					#	 a variant containing a float64 array 'a'
+	descriptors = struct.pack(">HHB", 5, 0x000A, 0)		# float64 element descriptor
+	descriptors += struct.pack(">HHH", 8+4*n, 0x0040, n) + b'\xff'*4*n + struct.pack(">H", 0)
+	return (struct.pack(">LL", 0x16008000, 2) + descriptors + struct.pack(">HH", 1, 1)
+		+ struct.pack(">" + "L"*n, *a.shape) + a.astype(">f8").tobytes() + struct.pack(">L", 0)).hex()
+
+def retype(flattened, fromCode, toCode):	# Changes the typecode of every descriptor of type 'fromCode'.
+	b = bytearray(flattened)				# Used for the types 'sendToLabview()' never writes (enums and
+	i = 8									# physical quantities), whose data is laid out the same way.
+	for __ in range(lv.bytesToInt(b[4:8])):
+		if b[i+3] == fromCode:
+			b[i+3] = toCode
+		i += lv.bytesToInt(b[i:i+2])
+	return b
+
+def flattenPath(drive, components):		# Builds a variant containing a LabVIEW path
+	parts = [drive.encode()] + [c.encode() for c in components]
+	body = struct.pack(">HH", 0, len(parts)) + b''.join(bytes([len(p)]) + p for p in parts)
+	descriptor = struct.pack(">HHL", 8, 0x0032, 0)
+	return bytearray(struct.pack(">LL", 0x16008000, 1) + descriptor + struct.pack(">HH", 1, 0)
+		+ b'PTH0' + struct.pack(">L", len(body)) + body + struct.pack(">L", 0))
+
+############################ EXACT COMPARISON ############################
+##########################################################################
+def sameValue(a, b):	# True if 'b' is exactly 'a': same types, shapes and bits. Arrays
+	if isinstance(a, lv.variant):	# may differ only in byte order, since LabVIEW is big-endian.
+		return isinstance(b, lv.variant) and sameValue(a.data, b.data)
+	if isinstance(a, list):
+		return isinstance(b, list) and len(a) == len(b) and all(map(sameValue, a, b))
+	if isinstance(a, np.ndarray):
+		if not isinstance(b, np.ndarray) or a.shape != b.shape:
+			return False
+		if a.dtype == object:
+			return b.dtype == object and all(map(sameValue, a.flat, b.flat))
+		if a.dtype.kind != b.dtype.kind or a.dtype.itemsize != b.dtype.itemsize:
+			return False
+		if a.dtype.kind == 'U':
+			return bool(np.all(a == b))
+		return a.astype(a.dtype.newbyteorder('=')).tobytes() == b.astype(b.dtype.newbyteorder('=')).tobytes()
+	if type(a) is not type(b):
+		return False
+	if isinstance(a, np.generic):
+		return a.tobytes() == b.tobytes()	# bitwise, so NaNs compare equal
+	return a == b
+
+############################## TEST CASES ################################
+##########################################################################
+numericTypes = [np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64,
+	np.float32, np.float64, np.complex64, np.complex128]
+
+typecodes = {	# typecodes written by 'sendToLabview()' for each numpy type
+	np.int8: 0x01, np.int16: 0x02, np.int32: 0x03, np.int64: 0x04, np.uint8: 0x05, np.uint16: 0x06,
+	np.uint32: 0x07, np.uint64: 0x08, np.float32: 0x09, np.float64: 0x0A, np.complex64: 0x0C, np.complex128: 0x0D
+}
+
+retypes = {		# typecodes only LabVIEW writes, and the numpy type they decode like
+	0x15: np.uint8, 0x16: np.uint16, 0x17: np.uint32,			# enums
+	0x19: np.float32, 0x1A: np.float64, 0x1C: np.complex64, 0x1D: np.complex128	# physical quantities
+}
+
+def randomArray(rng, t, shape):
+	if np.issubdtype(t, np.integer):
+		info = np.iinfo(t)
+		return rng.integers(info.min, info.max, size=shape, dtype=t, endpoint=True)
+	if np.issubdtype(t, np.complexfloating):
+		return (rng.standard_normal(shape) + 1j*rng.standard_normal(shape)).astype(t)
+	return rng.standard_normal(shape).astype(t)
+
+def randomScalar(rng, t):
+	return randomArray(rng, t, (1,))[0]
+
+def randomString(rng, maxLength=20):
+	return ''.join(rng.choice(list(string.ascii_letters + string.digits + " _-.:\\"), size=rng.integers(0, maxLength+1)))
+
+def cases(rng, arraySize):	# Returns (name, flattened, expected value) for every supported type code
+	result = []
+	def add(name, value, flattened=None):
+		result.append((name, lv.flatten(value) if flattened is None else flattened, value))
+
+	add("none 0x00", None)
+	for t in numericTypes:
+		name = "%s 0x%02X" % (t.__name__, typecodes[t])
+		add(name + " scalar", randomScalar(rng, t))
+		add(name + " array", randomArray(rng, t, (arraySize,)))
+	for code, t in sorted(retypes.items()):
+		name = "%s 0x%02X" % (t.__name__, code)
+		scalar, array = randomScalar(rng, t), randomArray(rng, t, (arraySize,))
+		add(name + " scalar", scalar, retype(lv.flatten(scalar), typecodes[t], code))
+		add(name + " array", array, retype(lv.flatten(array), typecodes[t], code))
+	add("bool 0x21 scalar", True)
+	add("bool 0x21 array", rng.integers(0, 2, size=arraySize).astype(bool))
+	add("string 0x30 scalar", randomString(rng))
+	add("string 0x30 array", np.array([randomString(rng) for __ in range(max(1, arraySize//100))]))
+	add("path 0x32", "C:\\Users\\stave\\image_001.png", flattenPath("C", ["Users", "stave", "image_001.png"]))
+	add("array 0x40 2-d", randomArray(rng, np.float64, (arraySize//100 or 1, 100)))
+	add("array 0x40 3-d", randomArray(rng, np.int16, (4, 5, max(1, arraySize//20))))
+	add("array 0x40 empty", np.empty((0, 3), dtype=np.float64))
+	add("cluster 0x50 flat", [randomScalar(rng, np.int32), randomScalar(rng, np.float64), False])
+	add("cluster 0x50 nested", ["C:\\image.png", [randomScalar(rng, np.float64), randomScalar(rng, np.float64)]])
+	add("cluster 0x50 empty", [])
+	clusters = np.empty((max(1, arraySize//10),), dtype=object)
+	for i in range(len(clusters)):
+		clusters[i] = [randomScalar(rng, np.uint16), randomScalar(rng, np.float64), randomScalar(rng, np.complex64)]
+	add("array of flat clusters", clusters)
+	clusters = np.empty((max(1, arraySize//100),), dtype=object)
+	for i in range(len(clusters)):
+		clusters[i] = [randomString(rng), randomArray(rng, np.float32, (int(rng.integers(0, 10)),))]
+	add("array of clusters with strings and arrays", clusters)
+	add("variant 0x53", lv.variant([randomScalar(rng, np.int8), randomString(rng)]))
+	add("variant 0x53 nested", [lv.variant(lv.variant(randomArray(rng, np.float64, (10,)))), None])
+	return result
+
+############################## RANDOM FUZZ ###############################
+##########################################################################
+# Random values are drawn from random type trees, so that every element of an array of
+# clusters has the same layout, as LabVIEW requires.
+def randomType(rng, depth):
+	kind = rng.choice(["scalar", "bool", "string", "array", "cluster", "variant"] if depth > 0 else ["scalar", "bool", "string"])
+	if kind == "scalar":
+		return ("scalar", numericTypes[rng.integers(len(numericTypes))])
+	if kind == "array":
+		element = randomType(rng, 0) if rng.random() < 0.7 else ("cluster", [randomType(rng, depth-1) for __ in range(rng.integers(1, 4))])
+		while element[0] == "cluster" and containsArray(element):	# LabVIEW arrays of arrays are not allowed,
+			element = randomType(rng, 0)								# so keep array elements simple
+		return ("array", element, int(rng.integers(1, 4)))
+	if kind == "cluster":
+		return ("cluster", [randomType(rng, depth-1) for __ in range(rng.integers(0, 5))])
+	if kind == "variant":
+		return ("variant", randomType(rng, depth-1))
+	return (kind,)
+
+def containsArray(t):
+	if t[0] == "array":
+		return True
+	return t[0] == "cluster" and any(map(containsArray, t[1]))
+
+def randomFromType(rng, t):
+	if t[0] == "scalar":
+		return randomScalar(rng, t[1])
+	if t[0] == "bool":
+		return bool(rng.integers(2))
+	if t[0] == "string":
+		return randomString(rng)
+	if t[0] == "variant":
+		return lv.variant(randomFromType(rng, t[1]))
+	if t[0] == "cluster":
+		return [randomFromType(rng, e) for e in t[1]]
+	element, ndim = t[1], t[2]
+	shape = tuple(int(rng.integers(0 if element[0] == "scalar" else 1, 5)) for __ in range(ndim))
+	if element[0] == "scalar":
+		return randomArray(rng, element[1], shape)
+	if element[0] == "bool":
+		return rng.integers(0, 2, size=shape).astype(bool)
+	if element[0] == "string":
+		return np.array([randomString(rng) for __ in range(int(np.prod(shape)))]).reshape(shape)
+	a = np.empty(shape, dtype=object)
+	for c in np.ndindex(*shape):
+		a[c] = randomFromType(rng, element)
+	return a
+
+def fuzz(rng, n):	# Returns the number of values that failed to round-trip, and examples of them
+	failures, examples = 0, []
+	for __ in range(n):
+		value = randomFromType(rng, randomType(rng, 3))
+		try:
+			ok = sameValue(value, lv.unflatten(lv.bytestream(lv.flatten(value))))
+			error = None if ok else "value changed"
+		except Exception as e:
+			ok, error = False, "%s: %s" % (e.__class__.__name__, e)
+		if not ok:
+			failures += 1
+			if len(examples) < 10:
+				examples.append({"value": repr(value)[:500], "error": error})
+	return failures, examples
+
+################################ TIMING ##################################
+##########################################################################
+def timeCalls(call, setup=None, minTime=0.2):	# Returns the mean time per call, in seconds.
+	calls, total = 0, 0.0						# 'setup' runs untimed before every call.
+	while total < minTime or calls == 0:
+		if setup:
+			setup()
+		start = time.perf_counter()
+		call()
+		total += time.perf_counter() - start
+		calls += 1
+	return total/calls
+
+def send(value, binFile=None):		# 'sendToLabview()', returning what it printed
+	out, stdout = io.StringIO(), sys.__stdout__
+	sys.__stdout__ = out
+	try:
+		lv.sendToLabview(value, binFile)
+	finally:
+		sys.__stdout__ = stdout
+		sys.stdout = stdout
+	return out.getvalue().strip()
+
+def get(arg):		# 'getFromLabview()' on 'arg', as if it was passed by PythonWrapper.vi
+	argv = sys.argv
+	sys.argv = [argv[0], arg]
+	try:
+		return lv.getFromLabview()
+	finally:
+		sys.argv = argv
+		sys.stdout = sys.__stdout__		# 'getFromLabview()' leaves printing disabled
+
+def measure(name, flattened, expected, binFile):
+	size = len(flattened)
+	hexString = bytes(flattened).hex()
+	def writeBin():
+		with open(binFile, "wb") as f:
+			f.write(flattened)
+
+	result = {"case": name, "bytes": size}
+	result["encodeRoundTrip"] = sameValue(expected, lv.unflatten(lv.bytestream(lv.flatten(expected))))
+	result["hexDecodeExact"] = sameValue(expected, get(hexString))
+	writeBin()
+	result["binDecodeExact"] = sameValue(expected, get("bin" + binFile))
+	result["exact"] = result["encodeRoundTrip"] and result["hexDecodeExact"] and result["binDecodeExact"]
+
+	timings = {
+		"sendHex"	:	timeCalls(lambda: send(expected)),
+		"sendBin"	:	timeCalls(lambda: send(expected, binFile)),
+		"getHex"	:	timeCalls(lambda: get(hexString)),
+		"getBin"	:	timeCalls(lambda: get("bin" + binFile), writeBin)
+	}
+	for key, t in timings.items():
+		result[key + "_us"] = t*1e6
+		result[key + "_MBps"] = size/t/1e6
+	return result
+
+def runSuite(output, fuzzCount, seed, arraySize):
+	rng = np.random.default_rng(seed)
+	lv.suppressPrinting = False
+	binFile = os.path.join(tempfile.mkdtemp(), "LabviewPasserBenchmark.bin")
+	results = [measure(name, flattened, expected, binFile) for name, flattened, expected in cases(rng, arraySize)]
+	failures, examples = fuzz(rng, fuzzCount)
+
+	report = {
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"seed": seed,
+		"arraySize": arraySize,
+		"cases": results,
+		"fuzz": {"count": fuzzCount, "failures": failures, "examples": examples}
+	}
+	with open(output, "w") as f:
+		json.dump(report, f, indent=2)
+
+	print("%-44s %10s %10s %10s %10s %10s  %s" % ("case", "bytes", "sendHex", "getHex", "sendBin", "getBin", "exact"))
+	for r in results:
+		print("%-44s %10d %8.1fus %8.1fus %8.1fus %8.1fus  %s" % (r["case"], r["bytes"],
+			r["sendHex_us"], r["getHex_us"], r["sendBin_us"], r["getBin_us"], r["exact"]))
+	print("fuzz: %d/%d random values failed to round-trip" % (failures, fuzzCount))
+	print("results written to " + output)
+	return all(r["exact"] for r in results) and failures == 0
+
+def runCompare(size):
+	a = np.random.default_rng(0).standard_normal((size, size))
+	payload = flattenFloat64Array(a)
+	lv.suppressPrinting = False
+
+	lv.vectorizeArrays = True
+	tFast = timeCalls(lambda: get(payload), minTime=0)
+	lv.vectorizeArrays = False
+	tSlow = timeCalls(lambda: get(payload), minTime=0)
+	slow = get(payload)
+	lv.vectorizeArrays = True
+	if not (np.array_equal(get(payload), a) and np.array_equal(slow, a)):
+		raise AssertionError("decoded array does not match the original")
+
+	mb = a.nbytes/1e6
+	print("%dx%d float64 array (%.1f MB)" % (size, size, mb))
+	print("  vectorized:  %10.4f s  %10.1f MB/s" % (tFast, mb/tFast))
+	print("  per-element: %10.4f s  %10.1f MB/s" % (tSlow, mb/tSlow))
+	print("  speedup:     %10.1fx" % (tSlow/tFast))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark and round-trip checks for LabviewPasser")
+	commands = parser.add_subparsers(dest="command")
+	suite = commands.add_parser("suite", help="time and check every supported type code")
+	suite.add_argument("--output", default="LabviewPasserBenchmark.json", help="JSON results file")
+	suite.add_argument("--fuzz", type=int, default=500, help="number of random nested values to round-trip")
+	suite.add_argument("--seed", type=int, default=0)
+	suite.add_argument("--array-size", type=int, default=100000, help="number of elements in array cases")
+	compare = commands.add_parser("compare", help="vectorized vs per-element array decoding")
+	compare.add_argument("size", type=int, nargs="?", default=2048)
+	args = parser.parse_args()
+
+	if args.command == "compare":
+		runCompare(args.size)
+	else:
+		if args.command is None:
+			args = suite.parse_args([])
+		sys.exit(0 if runSuite(args.output, args.fuzz, args.seed, args.array_size) else 1)
@@ -1,3 +1,7 @@
+import os
+import glob
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from scipy import optimize as ls
 import numpy as np
@@ -6,38 +10,97 @@ from PythonLabVIEW import LabviewPasser as lv
 p2m = 1.5866
 wireRadius = 90/2/p2m
 cropRadii = 1.5
+maxNfev = 25
+batchWorkers = os.cpu_count() or 1
+imageExtensions = ["*.png", "*.bmp", "*.tif", "*.tiff", "*.jpg"]
+batchPool = None	# created on the first batch, then kept, so a long-lived worker only starts its processes once
 
-def imageToArray(filename):
-	im = Image.open(filename)
-	(w, h) = im.size
-	pixels = np.array(im)
-	values = list(map(lambda x: (np.sum(pixels[x])/w), range(h)))
-	mean = np.mean(values)
-	return list(map(lambda x: (values[x]-mean)**2, range(0, len(values))))
+def getBatchPool():
+	global batchPool
+	if batchPool is None:
+		batchPool = ProcessPoolExecutor(batchWorkers)
+	return batchPool
+
+def imageToArray(filename, columns=None, columnStep=1):	# Squared deviation of each row's brightness from the mean.
+	im = Image.open(filename)								# 'columns' = (left, right) only projects that band of
+	(w, h) = im.size										# the image, and 'columnStep' only every n-th column of it
+	left, right = columns if columns is not None else (0, w)
+	if (left, right) != (0, w):
+		im = im.crop((left, 0, right, h))	# crop before converting, so only the band becomes an array
+	pixels = np.asarray(im)[:, ::columnStep]
+	sums = pixels.reshape(h, -1).sum(axis=1, dtype=np.uint32)	# sums over width and colour, exact in integers
+	values = np.divide(sums, pixels.shape[1], dtype=np.float32)
+	values -= values.mean()
+	return np.square(values, out=values)
 
 def model(x, params):
 	A, m, c = params
 	cos2 = ((x - m)/wireRadius)**2
-	if cos2 < 1:
-		sin2 = 1-cos2
-		return A*np.exp(-c*cos2/sin2)*sin2
-	return 0
+	inside = cos2 < 1					# the profile is zero outside the wire. 'sin2' is
+	sin2 = np.where(inside, 1-cos2, 1)	# set to 1 there only to keep the division finite
+	return np.where(inside, A*np.exp(-c*cos2/sin2)*sin2, 0)
+
+def jacobian(x, params):	# derivatives of 'model' with respect to (A, m, c), one row per x
+	A, m, c = params
+	cos2 = ((x - m)/wireRadius)**2
+	inside = cos2 < 1
+	sin2 = np.where(inside, 1-cos2, 1)
+	e = np.where(inside, np.exp(-c*cos2/sin2), 0)
+	return np.column_stack((e*sin2, 2*A*e*(1 + c/sin2)*(x - m)/wireRadius**2, -A*e*cos2))
 
 def initialGuesser(dataY, c, r):
 	if int(c-0.5) == -1:
 		c, r = np.argmax(dataY), 30
 	return [dataY[int(c+0.5)], c, r]
 
-[imageFilePath, [guessC, guessR]] = lv.getFromLabview()
-dataY = imageToArray(imageFilePath)
-B0 = initialGuesser(dataY, guessC, guessR)
-xMin, xMax = int(B0[1] - cropRadii*wireRadius), int(B0[1] + cropRadii*wireRadius) + 1
-def residuals(params):
-	return list(map(lambda x: dataY[x]-model(x, params), range(xMin, xMax)))
-fit = ls.least_squares(residuals, B0, method = "trf", xtol = 0.000001, diff_step = [0.0001, 0.00002, 0.01], max_nfev = 25)
-if not fit.success or fit.x[2] < 0:
-	lv.sendToLabview([fit.x, np.empty(3), fit.nfev, [np.array(range(xMin, xMax)), np.array(dataY[xMin: xMax]), np.array(list(map(lambda x: model(x, fit.x), range(xMin, xMax))))]])
-	exit(3)
-errors = np.sqrt(np.diagonal(np.linalg.inv(np.matmul(np.transpose(fit.jac), fit.jac))))
-# lv.sendToLabview([fit.x, errors, fit.nfev, [np.empty((0,), dtype=np.float64), np.empty((0,), dtype=np.float64), np.empty((0,), dtype=np.float64)]])
-lv.sendToLabview([fit.x, errors, fit.nfev, [np.array(range(xMin, xMax)), np.array(dataY[xMin: xMax]), np.array(list(map(lambda x: model(x, fit.x), range(xMin, xMax))))]])
+def fitProfile(dataY, guessC, guessR):	# Returns the fit, its parameter errors (None if the fit failed), and the fitted window
+	B0 = initialGuesser(dataY, guessC, guessR)
+	xMin, xMax = int(B0[1] - cropRadii*wireRadius), int(B0[1] + cropRadii*wireRadius) + 1
+	x = np.arange(xMin, xMax)
+	y = np.asarray(dataY)[x].astype(np.float64)	# sent to LabVIEW as DBL, like the profile before it was float32
+	def residuals(params):
+		return y - model(x, params)
+	def residualsJacobian(params):
+		return -jacobian(x, params)
+	fit = ls.least_squares(residuals, B0, jac = residualsJacobian, method = "trf", xtol = 0.000001, max_nfev = maxNfev)
+	if not fit.success or fit.x[2] < 0:
+		return fit, None, x, y
+	errors = np.sqrt(np.diagonal(np.linalg.inv(np.matmul(np.transpose(fit.jac), fit.jac))))	# 'fit.jac' is the analytic Jacobian at the solution
+	return fit, errors, x, y
+
+@lv.register("ProcessImage")
+def processImage(args):
+	[imageFilePath, [guessC, guessR]] = args
+	fit, errors, x, y = fitProfile(imageToArray(imageFilePath), guessC, guessR)
+	if errors is None:
+		raise lv.LabviewExit(3, [fit.x, np.empty(3), fit.nfev, [x, y, model(x, fit.x)]])
+	# return [fit.x, errors, fit.nfev, [np.empty((0,), dtype=np.float64), np.empty((0,), dtype=np.float64), np.empty((0,), dtype=np.float64)]]
+	return [fit.x, errors, fit.nfev, [x, y, model(x, fit.x)]]
+
+def imagePaths(images):	# 'images' is a list of image paths, a directory, or a glob pattern
+	if not isinstance(images, str):
+		return [str(path) for path in np.ravel(images)]
+	if os.path.isdir(images):
+		return sorted(path for ext in imageExtensions for path in glob.glob(os.path.join(images, ext)))
+	return sorted(glob.glob(images))
+
+def fitImageRun(imageFilePaths, guessC, guessR):	# Fits a run of neighbouring images in order, seeding
+	rows = []										# each fit with the result of the previous one
+	for imageFilePath in imageFilePaths:
+		fit, errors, __, __ = fitProfile(imageToArray(imageFilePath), guessC, guessR)
+		success = errors is not None
+		rows.append(list(fit.x) + list(errors if success else np.full(3, np.nan)) + [fit.nfev, success])
+		if success:
+			guessC, guessR = fit.x[1], fit.x[2]
+	return rows
+
+@lv.register("ProcessImageBatch")
+def processImageBatch(args):	# Returns the image paths, and one row per image of
+	[images, [guessC, guessR]] = args	# (A, m, c, error A, error m, error c, nfev, success)
+	paths = imagePaths(images)
+	runs = [list(run) for run in np.array_split(paths, min(batchWorkers, len(paths))) if len(run)] if paths else []
+	rows = [row for run in getBatchPool().map(fitImageRun, runs, repeat(guessC), repeat(guessR)) for row in run]	# each worker fits one contiguous run of images
+	return [np.array(paths, dtype=str), np.array(rows, dtype=np.float64).reshape(len(rows), 8)]
+
+if __name__ == "__main__":
+	lv.runFromLabview(lambda args: processImage(args) if isinstance(args[0], str) and os.path.isfile(args[0]) else processImageBatch(args))
@@ -1,26 +1,275 @@
 #!/usr/bin/env /Users/zschillaci/Software/miniconda3/envs/pyenv/bin/python
 import os
-import sys
 import collections
-import math as mt
+import hashlib
+import pickle
 import numpy as np
 import pandas as pd
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 def StrRound(val, floating=2):
     return str(round(val, floating))
 
-def StringtoFlt(string):
-    flt = None
-    if ("\n" in string):
-        string.replace("\n", "")
-    if ("=" in string):
-        string = string[string.find("=") + 1:]
-    try:
-        flt = float(string)
-    except ValueError:
-        print("Cannot convert string to float!")
-    return flt
+CORNER_NAMES = 'ABCD'
+DIMENSIONS = ['X', 'Y', 'Z']
+
+# One record per measurement line: indices into the corners, stages and dimensions, and the value
+RECORD = np.dtype([('corner', np.int8), ('stage', np.int16), ('dim', np.int8), ('value', np.float64)])
+
+# Reads a Module_N.txt survey in one pass. Corner markers ("[CornerA]") switch the corner,
+# and every "X_<stage> = <value>" line after them becomes a record. Returns the stages in
+# the order they first appear, the values as an array of corner x stage x dimension (NaN
+# where missing), and a list of (line number, message) for every line that could not be parsed
+def ParseSurvey(infile, corners=CORNER_NAMES):
+    reader = SurveyReader(infile, corners)
+    reader.Read(final=True)
+    return reader.Result()
+
+# Parses a survey file as it is written, picking up from the end of the last read. If what was
+# already read has changed (the file was rewritten rather than appended to), it starts over. An
+# unfinished last line read with 'final' is only tentative, and is read again the next time
+class SurveyReader(object):
+    def __init__(self, infile, corners=CORNER_NAMES):
+        self.infile = infile
+        self.corners = corners
+        self.cornerIndex = {corner: i for i, corner in enumerate(corners)}
+        self.dimIndex = {dim: i for i, dim in enumerate(DIMENSIONS)}
+        self.Reset()
+
+    def Reset(self):
+        self.offset = 0
+        self.digest = hashlib.sha1()
+        self.lineno = 0
+        self.corner = None
+        self.stages = collections.OrderedDict()
+        self.errors = []
+        self.chunks = []
+        self.tentative = None
+
+    # Parses the lines added since the last read, leaving an unfinished last line (one without
+    # a newline) for the next read unless 'final'. Returns the number of new records
+    def Read(self, final=False):
+        if self.tentative is not None:
+            self.offset, self.digest, self.lineno, self.corner, self.stages, errors, chunks = self.tentative
+            del self.errors[errors:], self.chunks[chunks:]
+            self.tentative = None
+
+        with open(self.infile, 'rb') as f_in:
+            data = f_in.read()
+        if len(data) < self.offset or hashlib.sha1(data[:self.offset]).digest() != self.digest.digest():
+            self.Reset()
+        end = data.rfind(b'\n') + 1
+        n = self.Parse(data[self.offset:max(end, self.offset)])
+        if final and len(data) > self.offset:
+            self.tentative = (self.offset, self.digest.copy(), self.lineno, self.corner, self.stages.copy(), len(self.errors), len(self.chunks))
+            n += self.Parse(data[self.offset:])
+        return n
+
+    def Parse(self, data):
+        self.offset += len(data)
+        self.digest.update(data)
+
+        # At most one record per line
+        lines = data.decode(errors='replace').splitlines()
+        records = np.empty(len(lines), dtype=RECORD)
+        n = 0
+        stages, errors = self.stages, self.errors
+        for lineno, line in enumerate(lines, self.lineno + 1):
+            self.lineno = lineno
+            line = line.strip()
+            if not line:
+                continue
+            if ("Corner" in line):
+                name = line[line.find("Corner") + len("Corner"):].strip("[] ")
+                self.corner = self.cornerIndex.get(name)
+                if self.corner is None:
+                    errors.append((lineno, "unknown corner '" + name + "'"))
+                continue
+
+            key, sep, value = line.partition("=")
+            dim, _, stage = key.strip().partition("_")
+            stage = stage.strip()
+            if not sep or not stage:
+                errors.append((lineno, "expected '<dimension>_<stage> = <value>', got '" + line + "'"))
+                continue
+            if dim not in self.dimIndex:
+                errors.append((lineno, "unknown dimension '" + dim + "'"))
+                continue
+            if self.corner is None:
+                errors.append((lineno, "measurement outside of a corner"))
+                continue
+            try:
+                value = float(value.strip().strip('"'))
+            except ValueError:
+                errors.append((lineno, "cannot convert '" + value.strip() + "' to float"))
+                value = np.nan
+
+            records[n] = (self.corner, stages.setdefault(stage, len(stages)), self.dimIndex[dim], value)
+            n += 1
+
+        self.chunks.append(records[:n])
+        return n
+
+    # The stages, values and errors of everything read so far, as ParseSurvey returns them
+    def Result(self):
+        records = np.concatenate(self.chunks) if self.chunks else np.empty(0, dtype=RECORD)
+        values = np.full((len(self.corners), len(self.stages), len(DIMENSIONS)), np.nan)
+        values[records['corner'], records['stage'], records['dim']] = records['value']
+        return list(self.stages), values, list(self.errors)
+
+# Survey results of many modules, from one stave or several, in one array of module x stage x
+# corner x dimension. Rows are (stave, module) pairs and stages are shared by name, NaN where a
+# module has no survey. The columns of a module's own stages, in the order of its file, are in
+# self.order, and its first and last stages come from that order rather than the shared one.
+# Displacements, angles and tolerance flags are all derived once, here
+class SurveyStore(object):
+    # 'surveys' is a list of (stave, module, stages, values, errors), the last three as ParseSurvey returns them
+    def __init__(self, surveys, tolerance=25, dimensions=['X', 'Y']):
+        self.tolerance = tolerance
+        self.dimensions = dimensions
+        self.staves = [survey[0] for survey in surveys]
+        self.modules = [survey[1] for survey in surveys]
+        self.errors = [survey[4] for survey in surveys]
+
+        stages = collections.OrderedDict()
+        for survey in surveys:
+            for stage in survey[2]:
+                stages.setdefault(stage, len(stages))
+        self.stages = list(stages)
+
+        # (at least one stage, even if unnamed, so that every module has a first and last)
+        self.values = np.full((len(surveys), max(len(stages), 1), len(CORNER_NAMES), len(DIMENSIONS)), np.nan)
+        self.order = []
+        for row, survey in enumerate(surveys):
+            self.order.append(np.array([stages[stage] for stage in survey[2]], dtype=int))
+            self.values[row, self.order[row]] = np.swapaxes(survey[3], 0, 1)
+        self.Derive()
+
+    # Parses Module_N.txt in 'infile' for each of the modules, skipping those without a file.
+    # With a SurveyCache, only files that changed since it was saved are parsed
+    @classmethod
+    def FromFiles(cls, stave, infile, modules, tolerance=25, cache=None):
+        surveys = []
+        for module in modules:
+            path = infile + '/Module_' + str(module) + '.txt'
+            if not os.path.isfile(path):
+                continue
+            if cache is None:
+                surveys.append((stave, module) + tuple(ParseSurvey(path)))
+                continue
+            entry = cache.Entry((stave, module), cache.Hash(path))
+            if 'survey' not in entry:
+                entry['survey'] = tuple(ParseSurvey(path))
+            surveys.append((stave, module) + entry['survey'])
+        return cls(surveys, tolerance)
+
+    # One store of the rows of several, e.g. to compare staves
+    @classmethod
+    def Concatenate(cls, stores, tolerance=25):
+        surveys = []
+        for store in stores:
+            for row in range(len(store.modules)):
+                surveys.append((store.staves[row], store.modules[row], store.Stages(row), np.swapaxes(store.values[row, store.order[row]], 0, 1), store.errors[row]))
+        return cls(surveys, tolerance)
+
+    def Row(self, stave, module):
+        for row, key in enumerate(zip(self.staves, self.modules)):
+            if key == (stave, module):
+                return row
+        raise KeyError("no survey of module " + str(module) + " on " + str(stave))
+
+    # The module's stages, in the order of its file
+    def Stages(self, row):
+        return [self.stages[column] for column in self.order[row]]
+
+    def Derive(self):
+        rows = np.arange(len(self.modules))
+
+        # Stages each module was surveyed at, and the first and last of them in its own order
+        self.measured = np.zeros(self.values.shape[:2], dtype=bool)
+        for row, order in enumerate(self.order):
+            self.measured[row, order] = True
+        self.first = np.array([order[0] if len(order) else 0 for order in self.order], dtype=int)
+        self.last = np.array([order[-1] if len(order) else 0 for order in self.order], dtype=int)
+
+        # Displacement from each module's first stage [um]
+        self.relative = 1000 * (self.values - self.values[rows, self.first][:, np.newaxis])
+
+        # Angles of the AB and CD edges [mrad], and their change from the first stage [urad]
+        x, y = DIMENSIONS.index('X'), DIMENSIONS.index('Y')
+        pairs = [[CORNER_NAMES.index(c) for c in pair] for pair in ['AB', 'CD']]
+        first, second = np.array(pairs).T
+        dx = self.values[:, :, first, x] - self.values[:, :, second, x]
+        dy = self.values[:, :, first, y] - self.values[:, :, second, y]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.angles = 1000 * np.arctan(dy / dx)
+        self.relativeAngles = 1000 * (self.angles - self.angles[rows, self.first][:, np.newaxis])
+
+        # Corners out of tolerance at each module's last stage, as module x corner x dimension
+        dims = [DIMENSIONS.index(dim) for dim in self.dimensions]
+        self.final = self.relative[rows, self.last][:, :, dims]
+        self.flags = np.abs(self.final) >= self.tolerance
+        self.passed = ~self.flags.any(axis=(1, 2))
+
+    def Failures(self, row):
+        failures = []
+        for d, dim in enumerate(self.dimensions):
+            for c, corner in enumerate(CORNER_NAMES):
+                if self.flags[row, c, d]:
+                    failures.append(corner + ': delta' + dim + ' = ' + StrRound(float(self.final[row, c, d])) + ' um')
+        return failures
+
+    # Displacements [um] of the given corners of every module, by dimension, at 'stage' or at
+    # each module's last stage, skipping modules not surveyed at that stage
+    def Placements(self, stage=None, corners=CORNER_NAMES, rows=None):
+        rows = np.arange(len(self.modules)) if rows is None else np.asarray(rows)
+        index = self.last[rows] if stage is None else np.full(len(rows), self.stages.index(stage))
+        rows, index = rows[self.measured[rows, index]], index[self.measured[rows, index]]
+        cols = [CORNER_NAMES.index(corner) for corner in CORNER_NAMES if corner in corners]
+        return {dim: self.relative[rows, index][:, cols, DIMENSIONS.index(dim)].ravel().tolist() for dim in self.dimensions}
+
+# Per-module results kept between runs, pickled next to the plots. An entry (a dict, keyed on
+# (stave, module)) is only reused while the module's file has the same content hash and the
+# analysis parameters are the same; otherwise it starts out empty and the module is 'changed'
+class SurveyCache(object):
+    def __init__(self, filename, tolerance=25, corners=CORNER_NAMES, load=True):
+        self.filename = filename
+        self.params = (tolerance, corners)
+        self.entries = {}
+        self.changed = set()
+        if not load:
+            return
+        try:
+            with open(filename, 'rb') as f_in:
+                cached = pickle.load(f_in)
+            if cached['params'] == self.params:
+                self.entries = cached['entries']
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass
+
+    @staticmethod
+    def Hash(path):
+        with open(path, 'rb') as f_in:
+            return hashlib.sha1(f_in.read()).hexdigest()
+
+    def Entry(self, key, digest):
+        entry = self.entries.get(key)
+        if entry is None or entry['hash'] != digest:
+            entry = self.entries[key] = {'hash': digest}
+            self.changed.add(key)
+        return entry
+
+    def Save(self):
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with open(self.filename + '.part', 'wb') as f_out:
+            pickle.dump({'params': self.params, 'entries': self.entries}, f_out, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.filename + '.part', self.filename)
 
 def SetYlim(ylim, yticks):
     #Set y-limits of plot based upon min. and max. of plots
@@ -35,7 +284,71 @@ def SavePlot(path, fname):
     plt.savefig(path + '/' + fname + '.png')
     plt.close()
 
-def PlotHistogram(placements, corners):
+# A figure of stacked axes with one line per label, drawn without pyplot so that it can be
+# reused from one plot to the next (only the line data, titles and ticks change)
+class PlotTemplate(object):
+    def __init__(self, naxes, labels):
+        self.figure = Figure(figsize=(10, 10))
+        FigureCanvasAgg(self.figure)
+        self.axes = []
+        self.lines = []
+        for n in range(naxes):
+            ax = self.figure.add_subplot(100 * naxes + 11 + n)
+            self.lines.append([ax.plot([], [], linestyle='--', marker='o', label=label)[0] for label in labels])
+            ax.legend(loc=9, ncol=4)
+            ax.set_xlabel('Stage in Process')
+            self.axes.append(ax)
+
+    # 'series' is a (y label, values) per axes, with a row of values per line. Without a
+    # suptitle the title goes on the (single) axes, as for the angle plots
+    def Draw(self, suptitle, titles, stages, series, ylim=None):
+        if suptitle is not None:
+            self.figure.suptitle(suptitle, fontsize=20)
+        for ax, lines, title, (ylabel, values) in zip(self.axes, self.lines, titles, series):
+            if suptitle is None:
+                ax.set_title(title, fontsize=20)
+            else:
+                ax.set_title(title)
+            for line, y in zip(lines, values):
+                line.set_data(np.arange(len(y)), y)
+            ax.relim()
+            ax.autoscale(True)
+
+            low, high = SetYlim(ax.get_ylim(), (ax.get_yticks(),))
+            ax.set_ylim(ylim if ylim is not None else (low, high))
+            ax.set_xticks(np.arange(len(stages)))
+            ax.set_xticklabels(stages)
+            ax.set_ylabel(ylabel)
+
+    def Save(self, path, fname):
+        os.makedirs(path, exist_ok=True)
+        self.figure.savefig(path + '/' + fname + '.png')
+
+# Templates already built in this process, by number of axes and line labels
+TEMPLATES = {}
+
+# Draws and saves one plot job, (path, file name, suptitle, axes titles, line labels, stages,
+# series, y limits), on this process's template for its layout
+def RenderPlot(job):
+    path, fname, suptitle, titles, labels, stages, series, ylim = job
+    key = (len(titles), tuple(labels))
+    if key not in TEMPLATES:
+        TEMPLATES[key] = PlotTemplate(*key)
+    TEMPLATES[key].Draw(suptitle, titles, stages, series, ylim)
+    TEMPLATES[key].Save(path, fname)
+
+# Renders plot jobs in a pool of worker processes, each reusing its own templates
+def RenderPlots(jobs, workers=None):
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            RenderPlot(job)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        list(pool.map(RenderPlot, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+
+# Histograms of the placements [um] in each dimension, saved to the 'results' directory
+def PlotHistogram(results, placements, corners):
     for dim in placements:
         fig = plt.figure("Histogram - " + dim,(10,10))
         fig.suptitle("Histogram - " + dim, fontsize = 20)
@@ -54,10 +367,11 @@ def PlotHistogram(placements, corners):
 
         ax.annotate('$\mu$ = ' + StrRound(np.mean(placements[dim])) + ' $\mu$m',xy=(0.995,0.965),xycoords='axes fraction',fontsize=16,horizontalalignment='right',verticalalignment='bottom')
         ax.annotate('$\sigma$ = ' + StrRound(np.std(placements[dim])) + ' $\mu$m',xy=(0.995,0.925),xycoords='axes fraction',fontsize=16,horizontalalignment='right',verticalalignment='bottom')
-        SavePlot(RESULTS_FILE, dim + '-Corners' + corners + '-histogram')
+        SavePlot(results, dim + '-Corners' + corners + '-histogram')
 
 class TheSurvey(object):
-    def __init__(self, module, stave, infile):
+    # 'store' is a SurveyStore holding this module's survey; without one, the file is parsed on its own
+    def __init__(self, module, stave, infile, store=None):
         #Meta-data
         self.module = module
         self.stave = stave
@@ -68,10 +382,7 @@ class TheSurvey(object):
         self.tolerance = 25
        
         #Data
-        self.GetLines()
-        self.GetCorners()
-        self.GetStages()
-        self.GetResults()
+        self.GetResults(store)
         self.GetAngles()
         self.GetFlags()
 
@@ -80,33 +391,11 @@ class TheSurvey(object):
         print('Module:', self.module)
         print('Stave:', self.stave)
         print('File:', self.infile)
+        for lineno, error in self.errors:
+            print('Line ' + str(lineno) + ': ' + error)
         print('')
         self.PrintOverview()
 
-    # reads the file into the "lines" field
-    def GetLines(self):
-        with open(self.infile) as f_in:
-            self.lines = list(filter(None, (line.rstrip() for line in f_in)))
-
-    # gathers information about each corner from self.lines into self.corners (ordered dict)
-    def GetCorners(self):
-        indA, indB, indC, indD = 0, 0, 0, 0
-        for ind, line in enumerate(self.lines): # iterate over self.lines (line) with the counter (ind)
-            if ("CornerA" in line): # find line number where information about each corner begins
-                indA = ind + 1
-            elif ("CornerB" in line):
-                indB = ind + 1
-            elif ("CornerC" in line):
-                indC = ind + 1
-            elif ("CornerD" in line):
-                indD = ind + 1
-
-        self.corners = collections.OrderedDict()
-        self.corners['A'] = self.lines[indA : indB - 1] # save lines after corner A and before corner B in input file into ordered dictionary
-        self.corners['B'] = self.lines[indB : indC - 1]
-        self.corners['C'] = self.lines[indC : indD - 1]
-        self.corners['D'] = self.lines[indD : ]
-
     def RenameStages(self):
         stages = []
         for stage in self.stages:
@@ -123,60 +412,35 @@ class TheSurvey(object):
             stages.append(stage)
         self.stages = stages
 
-    # get a list the list of stages
-    def GetStages(self, rename=False):
-        self.stages = []
-        for line in self.corners['A']: # go through lines for A
-            stage = line[line.find("_") + 1: line.find("=") - 1] # get the stage (when data was taken)
-            if (stage not in self.stages): # add to self.stages if not already there
-                self.stages.append(stage)
-        # self.stages = RenameStages(self.stages)
-        return self.stages
-
-    def GetResults(self):
-        xdf, ydf = collections.OrderedDict(), collections.OrderedDict()
-        for corner, coords in self.corners.items():
-            xvals, yvals = [], []
-            for i in range(len(self.stages)):
-                xvals.append(StringtoFlt(coords[(3 * i)]))
-                yvals.append(StringtoFlt(coords[(3 * i) + 1]))
-            xdf[corner] = xvals
-            ydf[corner] = yvals
-        
-        self.xdf = pd.DataFrame(xdf, index=self.stages)
-        self.ydf = pd.DataFrame(ydf, index=self.stages)
+    # takes the module's row of the store (parsing the file into one if there is no store) as
+    # self.values (corner x stage x dimension), with each corner's stage x dimension block in
+    # self.corners (ordered dict)
+    def GetResults(self, store=None):
+        if store is None:
+            store = SurveyStore([(self.stave, self.module) + tuple(ParseSurvey(self.infile))], self.tolerance, self.dimensions)
+        self.store = store
+        self.row = store.Row(self.stave, self.module)
+        self.tolerance = store.tolerance
+        self.order = store.order[self.row]
+        self.stages = store.Stages(self.row)
+        self.values = np.swapaxes(store.values[self.row, self.order], 0, 1)
+        self.errors = store.errors[self.row]
+        self.corners = collections.OrderedDict((corner, self.values[i]) for i, corner in enumerate(CORNER_NAMES))
+
+        self.xdf = pd.DataFrame(self.values[:, :, 0].T, index=self.stages, columns=list(self.corners))
+        self.ydf = pd.DataFrame(self.values[:, :, 1].T, index=self.stages, columns=list(self.corners))
         self.results = {'X' : self.xdf, 'Y' : self.ydf}
 
-    def GetAngle(self, corners, stage):
-        c1, c2 = corners
-        dx = self.xdf[c1][stage] - self.xdf[c2][stage]
-        dy = self.ydf[c1][stage] - self.ydf[c2][stage]
-        try:
-            angle = 1000 * mt.atan(dy / dx)
-        except:
-            return -999
-        return angle
-
     def GetAngles(self):
-        angles = collections.OrderedDict()
-        angles['AB'] = [self.GetAngle('AB', stage) for stage in self.stages]
-        angles['CD'] = [self.GetAngle('CD', stage) for stage in self.stages]
-        self.angles = pd.DataFrame(angles, index=self.stages)
+        self.angles = pd.DataFrame(self.store.angles[self.row, self.order], index=self.stages, columns=['AB', 'CD'])
 
-    def GetRelative(self, df):
-        df = pd.DataFrame(df - df.iloc[0])
-        df = 1000 * df
-        return df
+    # displacements [um] from the first stage, from the store, as a stage x corner frame
+    def Relative(self, dim):
+        return pd.DataFrame(self.store.relative[self.row, self.order, :, DIMENSIONS.index(dim)], index=self.stages, columns=list(self.corners))
 
     def GetFlags(self):
-        self.passed = True
-        self.failures = []        
-        for dim in self.dimensions:
-            df = self.GetRelative(self.results[dim])
-            for corner in self.corners:
-                if (abs(df[corner][-1]) >= self.tolerance):
-                    self.passed = False
-                    self.failures.append(corner + ': delta' + dim + ' = ' + StrRound(df[corner][-1]) + ' um')
+        self.passed = bool(self.store.passed[self.row])
+        self.failures = self.store.Failures(self.row)
 
     def PrintOverview(self):
         if self.passed:
@@ -188,52 +452,34 @@ class TheSurvey(object):
         print('')
 
     def PopulateHistograms(self, placements, stage, corners='ABCD'):
+        for dim, values in self.store.Placements(stage, corners, [self.row]).items():
+            placements[dim].extend(values)
+
+    # prints the module's X and Y movement and returns it as a plot job (see RenderPlot) saving to
+    # the 'results' directory, drawing it straight away unless render is False
+    def PlotMovement(self, results, reference='relative', printOut=True, render=True):
+        units = ('[$\mu$m]' if (reference == 'relative') else '[mm]')
+        titles, series = [], []
         for dim in self.dimensions:
-            df = self.GetRelative(self.results[dim])
-            for corner in self.corners:
-                if (corner in corners):
-                    placements[dim].append(df[corner][stage])
-
-    def PlotMovement(self, reference='relative', printOut=True):
-        fig = plt.figure("Movement - " + reference,(10,10))
-        fig.suptitle("Movement - " + reference + " (" + self.stave + ", " + self.name + ")", fontsize = 20)
-        for n, dim in enumerate(self.dimensions):
-            plt.subplot(211 + n)
-            plt.title("Change in " + dim)
-
-            df = self.results[dim]
-            if (reference == 'relative'):
-                df = self.GetRelative(df)
-
-            for corner in self.corners:
-                plt.plot(np.arange(len(df[corner])), df[corner], linestyle='--', marker='o', label=corner)
-
-            units = ('[$\mu$m]' if (reference == 'relative') else '[mm]')
+            df = self.Relative(dim) if (reference == 'relative') else self.results[dim]
             if printOut:
                 print('-----' + dim + ' ' + units + '-----')
                 print(df)
                 print('--------------------' + '\n')
- 
-            low, high = SetYlim(plt.ylim(), plt.yticks())
-            plt.ylim(low, high)
-            plt.ylim(-50.5, 50.5)
-
-            plt.xlabel('Stage in Process')
-            plt.xticks(np.arange(len(self.stages)), self.stages)
-            plt.ylabel(dim + ' ' + units)
-            plt.legend(loc=9, ncol=4)
-        SavePlot(RESULTS_FILE, 'position-' + reference + '-' + self.name)
+            titles.append("Change in " + dim)
+            series.append((dim + ' ' + units, df.values.T))
 
-    def PlotAngle(self, reference='relative', printOut=True):
-        plt.figure("Angle Movement", (10, 10))
-        plt.title("Angle Movement" + " (" + self.stave + ", " + self.name + ")", fontsize = 20)
+        job = (results, 'position-' + reference + '-' + self.name, "Movement - " + reference + " (" + self.stave + ", " + self.name + ")",
+               titles, list(self.corners), self.stages, series, (-50.5, 50.5))
+        if render:
+            RenderPlot(job)
+        return job
 
+    # as PlotMovement, for the angles of the AB and CD edges
+    def PlotAngle(self, results, reference='relative', printOut=True, render=True):
         df = self.angles
         if (reference == 'relative'):
-            df = self.GetRelative(df)
-            
-        for col in self.angles.columns:
-            plt.plot(np.arange(len(df[col])), df[col], linestyle='--', marker='o', label=col)
+            df = pd.DataFrame(self.store.relativeAngles[self.row, self.order], index=self.stages, columns=self.angles.columns)
 
         units = ('[$\mu$rad]' if (reference == 'relative') else '[mrad]')
         if printOut:
@@ -241,42 +487,68 @@ class TheSurvey(object):
             print(df)
             print('--------------------' + '\n')
 
-        low, high = SetYlim(plt.ylim(), plt.yticks())
-        plt.ylim(low, high)
-
-        plt.xlabel('Stage in Process')
-        plt.xticks(np.arange(len(self.stages)), self.stages)
-        plt.ylabel('Angle ' + units)
-        plt.legend(loc=9, ncol=4)
-        SavePlot(RESULTS_FILE, 'angle-' + reference + '-' + self.name)
-
-# PARAMETERS #
-
-# Input and output directories
-INPUT_FILE = sys.argv[1]
-RESULTS_FILE = sys.argv[2]
-
-#Stave name
-STAVE = sys.argv[3]
-
-# List of module numbers on the stave (corresponding to survey files in STAVE sub-directory)
-MODULES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]
-
-# Plot placement histograms of all modules for specified corners (e.g. ['AB', 'CD', 'AC', 'AD', 'BC', 'BD', 'ABCD'])
-CORNERS = 'ABCD'
-PLACEMENTS = {'X': [], 'Y': []}
-
-# Plot and printout all survey results, highlighting any failures (placements outside tolerance)
-for module in MODULES:
-    try:
-        survey = TheSurvey(module, STAVE, INPUT_FILE)
-        if len(survey.stages) > 1:
-            survey.Dump()
+        job = (results, 'angle-' + reference + '-' + self.name, None, ["Angle Movement" + " (" + self.stave + ", " + self.name + ")"],
+               list(df.columns), self.stages, [('Angle ' + units, df.values.T)], None)
+        if render:
+            RenderPlot(job)
+        return job
+
+if __name__ == "__main__":
+    # PARAMETERS #
+
+    parser = argparse.ArgumentParser(description='Survey report of the modules on a stave')
+    parser.add_argument('input', help='directory of Module_N.txt survey files')
+    parser.add_argument('results', help='directory the plots are saved to')
+    parser.add_argument('stave', help='stave name')
+    parser.add_argument('--workers', type=int, default=None, help='processes rendering plots (default one per CPU)')
+    parser.add_argument('--rebuild', action='store_true', help='ignore the cache of previous runs and redo every module')
+    options = parser.parse_args()
+
+    # Input and output directories
+    INPUT_FILE = options.input
+    RESULTS_FILE = options.results
+
+    #Stave name
+    STAVE = options.stave
+
+    # List of module numbers on the stave (corresponding to survey files in STAVE sub-directory)
+    MODULES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]
+
+    # Plot placement histograms of all modules for specified corners (e.g. ['AB', 'CD', 'AC', 'AD', 'BC', 'BD', 'ABCD'])
+    CORNERS = 'ABCD'
+    PLACEMENTS = {'X': [], 'Y': []}
+
+    # Placement tolerance [um]
+    TOLERANCE = 25
+
+    # Parse the whole stave once, reusing the previous run's results of modules whose files are
+    # unchanged; every module's flags, displacements and angles come from the store
+    CACHE = SurveyCache(RESULTS_FILE + '/survey_cache.pkl', TOLERANCE, CORNERS, load=not options.rebuild)
+    STORE = SurveyStore.FromFiles(STAVE, INPUT_FILE, MODULES, TOLERANCE, CACHE)
+
+    # Printout all survey results, highlighting any failures (placements outside tolerance),
+    # and collect the plots of changed modules to render them all at once
+    JOBS = []
+    for module in MODULES:
+        try:
+            survey = TheSurvey(module, STAVE, INPUT_FILE, STORE)
+            entry = CACHE.entries[(STAVE, module)]
+            if len(survey.stages) > 1:
+                survey.Dump()
             
-            survey.PlotMovement(reference='relative', printOut=True)
-            survey.PlotAngle(reference='absolute', printOut=True)
+                jobs = [survey.PlotMovement(RESULTS_FILE, reference='relative', printOut=True, render=False),
+                        survey.PlotAngle(RESULTS_FILE, reference='absolute', printOut=True, render=False)]
+                if (STAVE, module) in CACHE.changed or not all(os.path.isfile(job[0] + '/' + job[1] + '.png') for job in jobs):
+                    JOBS.extend(jobs)
         
-            survey.PopulateHistograms(PLACEMENTS, survey.stages[-1], CORNERS)
-    except:
-        print("Error working with module {}".format(module))
-PlotHistogram(PLACEMENTS, CORNERS)
\ No newline at end of file
+                # The module's own last stage, relative to its own first, so the entry depends on its file alone
+                if 'placements' not in entry:
+                    entry['placements'] = {dim: [] for dim in PLACEMENTS}
+                    survey.PopulateHistograms(entry['placements'], survey.stages[-1], CORNERS)
+                for dim in PLACEMENTS:
+                    PLACEMENTS[dim].extend(entry['placements'][dim])
+        except:
+            print("Error working with module {}".format(module))
+    RenderPlots(JOBS, options.workers)
+    PlotHistogram(RESULTS_FILE, PLACEMENTS, CORNERS)
+    CACHE.Save()
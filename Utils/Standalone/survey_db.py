@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# Survey results of many staves in one SQLite database, so that trends across staves can be
+# queried without parsing their survey files again. Every corner of every module is a row per
+# stage, indexed by stave, side, module, corner and stage, with its position [mm] and its
+# displacement from the module's first stage [um].
+#
+# Usage:
+#   python survey_db.py surveys.sqlite ingest STAVE_DIR [STAVE_DIR ...] [--side SIDE]
+#   python survey_db.py surveys.sqlite summary [--stave STAVE] [--side SIDE] [--tolerance UM]
+import os
+import re
+import time
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+import survey
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS modules (
+    stave TEXT NOT NULL,
+    side TEXT NOT NULL,
+    module INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    stages INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    ingested REAL NOT NULL,
+    PRIMARY KEY (stave, side, module)
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    stave TEXT NOT NULL,
+    side TEXT NOT NULL,
+    module INTEGER NOT NULL,
+    corner TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    stage_index INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    x REAL, y REAL, z REAL,
+    dx REAL, dy REAL, dz REAL,
+    PRIMARY KEY (stave, side, module, corner, stage)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS measurements_stage ON measurements (stage, corner);
+CREATE INDEX IF NOT EXISTS measurements_last ON measurements (last, corner);
+"""
+
+COLUMNS = ['stave', 'side', 'module', 'corner', 'stage']
+
+# "col = ?" for each filter that is given, or "col IN (?, ...)" for a list of values
+def Where(filters):
+    clauses, params = [], []
+    for col, value in filters.items():
+        if value is None:
+            continue
+        if col not in COLUMNS:
+            raise ValueError("cannot filter on '" + col + "'")
+        if isinstance(value, (list, tuple, set)):
+            clauses.append(col + ' IN (' + ', '.join('?' * len(value)) + ')')
+            params.extend(value)
+        else:
+            clauses.append(col + ' = ?')
+            params.append(value)
+    return (' AND '.join(clauses) or '1'), params
+
+class SurveyDatabase(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    def Close(self):
+        self.connection.close()
+
+    # Adds (or replaces) the surveys of a stave directory of Module_N.txt files, skipping modules
+    # whose file is unchanged since it was last ingested. Returns the modules that were ingested
+    def Ingest(self, stave, infile, side='', modules=None):
+        if modules is None:
+            modules = sorted(int(m.group(1)) for m in (re.match(r'^Module_(\d+)\.txt$', fn) for fn in os.listdir(infile)) if m)
+
+        known = dict(self.connection.execute('SELECT module, hash FROM modules WHERE stave = ? AND side = ?', (stave, side)))
+        hashes = {}
+        for module in modules:
+            path = infile + '/Module_' + str(module) + '.txt'
+            if os.path.isfile(path):
+                digest = survey.SurveyCache.Hash(path)
+                if known.get(module) != digest:
+                    hashes[module] = digest
+        if not hashes:
+            return []
+
+        store = survey.SurveyStore.FromFiles(stave, infile, sorted(hashes))
+        now = time.time()
+        with self.connection:
+            for row, module in enumerate(store.modules):
+                self.connection.execute('DELETE FROM measurements WHERE stave = ? AND side = ? AND module = ?', (stave, side, module))
+                self.connection.execute('INSERT OR REPLACE INTO modules VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (stave, side, module, hashes[module], len(store.order[row]), len(store.errors[row]), now))
+
+            # One row per corner of each module's stages, in the order of its file. A stage's index
+            # is its place among the module's own stages, so that stages order the same way on every stave
+            rows = np.repeat(np.arange(len(store.modules)), [len(order) for order in store.order])
+            stages = np.concatenate(store.order + [np.empty(0, dtype=int)])
+            index = np.concatenate([np.arange(len(order)) for order in store.order] + [np.empty(0, dtype=int)])
+            values = store.values[rows, stages].reshape(-1, len(survey.DIMENSIONS))
+            relative = store.relative[rows, stages].reshape(-1, len(survey.DIMENSIONS))
+            ncorners = len(survey.CORNER_NAMES)
+            rows, stages, index = np.repeat(rows, ncorners), np.repeat(stages, ncorners), np.repeat(index, ncorners)
+            corners = np.tile(np.arange(ncorners), len(rows) // ncorners)
+
+            self.connection.executemany('INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((stave, side, store.modules[r], survey.CORNER_NAMES[c], store.stages[s], int(i), int(s == store.last[r])) +
+                 tuple(None if np.isnan(v) else float(v) for v in np.concatenate((value, rel)))
+                 for r, s, i, c, value, rel in zip(rows, stages, index, corners, values, relative)))
+        return list(store.modules)
+
+    # Every matching measurement as a DataFrame, e.g. Query(stave='S1', corner=['A', 'B'])
+    def Query(self, **filters):
+        where, params = Where(filters)
+        return pd.read_sql_query('SELECT * FROM measurements WHERE ' + where + ' ORDER BY stave, side, module, corner, stage_index', self.connection, params=params)
+
+    # Displacements [um] of the given corners, by dimension, at 'stage' or at each module's last
+    # stage, as for the stave histograms
+    def Placements(self, stage=None, corners=survey.CORNER_NAMES, dimensions=['X', 'Y'], **filters):
+        filters['corner'] = list(corners)
+        where, params = Where(filters)
+        where = where + (' AND last = 1' if stage is None else ' AND stage = ?')
+        params = params + ([] if stage is None else [stage])
+        cols = ', '.join('d' + dim.lower() for dim in dimensions)
+        values = np.array(self.connection.execute('SELECT ' + cols + ' FROM measurements WHERE ' + where, params).fetchall(), dtype=np.float64)
+        values = values.reshape(-1, len(dimensions))
+        return {dim: values[:, n][~np.isnan(values[:, n])] for n, dim in enumerate(dimensions)}
+
+    # Mean and spread of each corner's displacement [um] at each stage. Stages are ordered by the
+    # furthest place they have on any module, as a module that skipped a stage only moves later ones earlier
+    def Drift(self, **filters):
+        where, params = Where(filters)
+        df = pd.read_sql_query('SELECT corner, stage, MAX(stage_index) AS stage_index, COUNT(*) AS n, '
+                               'AVG(dx) AS dx, AVG(dx * dx) AS dx2, AVG(dy) AS dy, AVG(dy * dy) AS dy2 '
+                               'FROM measurements WHERE ' + where + ' GROUP BY corner, stage', self.connection, params=params)
+        for dim in ['dx', 'dy']:
+            df['std_' + dim] = np.sqrt(np.maximum(df[dim + '2'] - df[dim]**2, 0))
+        return df.drop(columns=['dx2', 'dy2']).sort_values(['corner', 'stage_index']).reset_index(drop=True)
+
+    # For each corner, how many modules it is out of tolerance on at their last stage (as the
+    # survey flags them), and the fraction of modules that is
+    def FailureRates(self, tolerance=25, **filters):
+        where, params = Where(filters)
+        df = pd.read_sql_query('SELECT corner, COUNT(*) AS modules, SUM(ABS(dx) >= ? OR ABS(dy) >= ?) AS failed '
+                               'FROM measurements WHERE last = 1 AND ' + where + ' GROUP BY corner ORDER BY corner',
+                               self.connection, params=[tolerance, tolerance] + params)
+        df['failed'] = df['failed'].fillna(0).astype(int)
+        df['rate'] = df['failed'] / df['modules']
+        return df
+
+    # Modules out of tolerance at their last stage, one row per module with the failing corners
+    def Failures(self, tolerance=25, **filters):
+        where, params = Where(filters)
+        return pd.read_sql_query("SELECT stave, side, module, GROUP_CONCAT(corner, '') AS corners "
+                                 'FROM measurements WHERE last = 1 AND (ABS(dx) >= ? OR ABS(dy) >= ?) AND ' + where +
+                                 ' GROUP BY stave, side, module ORDER BY stave, side, module',
+                                 self.connection, params=[tolerance, tolerance] + params)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Database of the survey results of many staves')
+    parser.add_argument('database', help='SQLite file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help='add stave directories of Module_N.txt files (named after the stave)')
+    ingest.add_argument('staves', nargs='+')
+    ingest.add_argument('--side', default='')
+    summary = commands.add_parser('summary', help='placements, drift and failure rates')
+    summary.add_argument('--stave', nargs='*', default=None)
+    summary.add_argument('--side', default=None)
+    summary.add_argument('--tolerance', type=float, default=25)
+    options = parser.parse_args()
+
+    with SurveyDatabase(options.database) as db:
+        if options.command == 'ingest':
+            for infile in options.staves:
+                stave = os.path.basename(os.path.normpath(infile))
+                modules = db.Ingest(stave, infile, options.side)
+                print(stave + ': ' + (str(len(modules)) + ' modules ingested' if modules else 'unchanged'))
+        else:
+            filters = {'stave': options.stave or None, 'side': options.side}
+            for dim, values in db.Placements(**filters).items():
+                print('delta' + dim + ' at last stage: n = ' + str(len(values)) + ', mean = ' + survey.StrRound(float(np.mean(values)) if len(values) else np.nan) +
+                      ' um, std = ' + survey.StrRound(float(np.std(values)) if len(values) else np.nan) + ' um')
+            print('')
+            print(db.Drift(**filters).to_string(index=False))
+            print('')
+            print(db.FailureRates(options.tolerance, **filters).to_string(index=False))
+            print('')
+            print(db.Failures(options.tolerance, **filters).to_string(index=False))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Watches a stave directory while its modules are surveyed, and reports whether each module is
+# within tolerance as soon as a new measurement is written to its Module_N.txt. Only the lines
+# appended since the last poll are parsed (see survey.SurveyReader). The stave's pass/fail
+# summary is printed, and optionally written as JSON to a file, after every change.
+#
+# Usage:
+#   python survey_watch.py STAVE_DIR STAVE [--poll SECONDS] [--idle SECONDS] [--summary FILE]
+import os
+import re
+import sys
+import time
+import json
+import argparse
+import numpy as np
+
+import survey
+
+class StaveWatcher(object):
+    def __init__(self, stave, infile, tolerance=25, summary=None):
+        self.stave = stave
+        self.infile = infile
+        self.tolerance = tolerance
+        self.summary = summary
+        self.readers = {}
+        self.stats = {}
+        self.results = {}
+
+    # Reads whatever was added to the stave's survey files since the last poll, and returns the
+    # modules that have new measurements. A file with an unfinished last line is finished once
+    # it has stopped changing for a poll
+    def Poll(self):
+        updated = []
+        for fn in sorted(os.listdir(self.infile)):
+            match = re.match(r'^Module_(\d+)\.txt$', fn)
+            if not match:
+                continue
+            module = int(match.group(1))
+            path = self.infile + '/' + fn
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stat = (stat.st_size, stat.st_mtime_ns)
+
+            reader = self.readers.setdefault(module, survey.SurveyReader(path))
+            if stat != self.stats.get(module):
+                self.stats[module] = stat
+                new = reader.Read()
+            elif reader.offset < stat[0]:
+                new = reader.Read(final=True)
+            else:
+                continue
+            if new or module not in self.results:
+                updated.append(module)
+        return updated
+
+    # Flags the module's corners at its latest stage and keeps the result. A module with no
+    # measurements yet (an empty file, or only a corner header) has passed None
+    def Update(self, module):
+        store = survey.SurveyStore([(self.stave, module) + self.readers[module].Result()], self.tolerance)
+        stages = [stage for stage, measured in zip(store.stages, store.measured[0]) if measured]
+        if np.isnan(store.values[0]).all():
+            self.results[module] = {'stage': None, 'stages': 0, 'passed': None, 'failures': []}
+        else:
+            self.results[module] = {'stage': stages[-1], 'stages': len(stages),
+                                    'passed': bool(store.passed[0]), 'failures': store.Failures(0)}
+        return self.results[module]
+
+    # Modules without measurements count as neither passed nor failed
+    def Summary(self):
+        failed = [module for module in sorted(self.results) if self.results[module]['passed'] is False]
+        unmeasured = [module for module in sorted(self.results) if self.results[module]['passed'] is None]
+        return {'stave': self.stave, 'tolerance': self.tolerance, 'time': time.time(), 'modules': len(self.results),
+                'passed': len(self.results) - len(failed) - len(unmeasured), 'failed': failed, 'unmeasured': unmeasured,
+                'results': {str(module): self.results[module] for module in sorted(self.results)}}
+
+    def Report(self, modules):
+        for module in modules:
+            result = self.Update(module)
+            if result['passed'] is None:
+                print(time.strftime('%H:%M:%S') + ' Module ' + str(module) + ': no measurements')
+            else:
+                print(time.strftime('%H:%M:%S') + ' Module ' + str(module) + ' (' + str(result['stage']) + '): ' +
+                      ('passed' if result['passed'] else 'FAILED ' + ', '.join(result['failures'])))
+        summary = self.Summary()
+        print('---> ' + self.stave + ': ' + str(summary['passed']) + '/' + str(summary['modules'] - len(summary['unmeasured'])) + ' modules within ' +
+              survey.StrRound(self.tolerance) + ' um' + (', failing: ' + ', '.join(str(m) for m in summary['failed']) if summary['failed'] else '') +
+              (', no measurements: ' + ', '.join(str(m) for m in summary['unmeasured']) if summary['unmeasured'] else ''))
+        sys.stdout.flush()
+
+        if self.summary is not None:
+            with open(self.summary + '.part', 'w') as f_out:
+                json.dump(summary, f_out, indent=1)
+            os.replace(self.summary + '.part', self.summary)
+
+    # Polls until there has been nothing new for 'idle' seconds, or forever if idle is None
+    def Run(self, poll=0.2, idle=None):
+        last = time.perf_counter()
+        while True:
+            updated = self.Poll()
+            if updated:
+                self.Report(updated)
+                last = time.perf_counter()
+            elif idle is not None and time.perf_counter() - last > idle:
+                break
+            time.sleep(poll)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report pass/fail of each module as its survey is written')
+    parser.add_argument('input', help='stave directory of Module_N.txt survey files')
+    parser.add_argument('stave', help='stave name')
+    parser.add_argument('--tolerance', type=float, default=25, help='placement tolerance [um]')
+    parser.add_argument('--poll', type=float, default=0.2, help='seconds between checks of the directory')
+    parser.add_argument('--idle', type=float, default=None, help='stop after this many seconds without a new measurement')
+    parser.add_argument('--summary', default=None, help='JSON file to keep the latest summary in')
+    options = parser.parse_args()
+
+    try:
+        StaveWatcher(options.stave, options.input, options.tolerance, options.summary).Run(options.poll, options.idle)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,130 @@
+import os
+import sys
+import pickle
+import subprocess
+import numpy as np
+
+import survey
+
+# Module_1 skips "Before Bridge Removal", so the stave-wide stage order is AG, ABR, BBR. Module_2's
+# last stage is still ABR, where it is within tolerance, although it is 40 um off at BBR
+MODULE_1 = """[CornerA]
+X_After Gluing = 1.000
+Y_After Gluing = 2.000
+X_After Bridge Removal = 1.001
+Y_After Bridge Removal = 2.001
+"""
+
+MODULE_2 = """[CornerA]
+X_After Gluing = 1.000
+Y_After Gluing = 2.000
+X_Before Bridge Removal = 1.040
+Y_Before Bridge Removal = 2.000
+X_After Bridge Removal = 1.005
+Y_After Bridge Removal = 2.000
+"""
+
+def WriteStave(path, modules):
+    for module, text in modules.items():
+        path.joinpath('Module_' + str(module) + '.txt').write_text(text)
+    return str(path)
+
+def test_modules_keep_their_own_stage_order(tmp_path):
+    infile = WriteStave(tmp_path, {1: MODULE_1, 2: MODULE_2})
+    store = survey.SurveyStore.FromFiles('S1', infile, [1, 2])
+
+    assert store.stages == ['After Gluing', 'After Bridge Removal', 'Before Bridge Removal']
+    assert store.Stages(1) == ['After Gluing', 'Before Bridge Removal', 'After Bridge Removal']
+    assert store.stages[store.last[1]] == 'After Bridge Removal'
+    assert list(store.passed) == [True, True]
+    assert np.allclose(store.Placements(corners='A')['X'], [1.0, 5.0])
+
+    module = survey.TheSurvey(2, 'S1', infile, store)
+    assert module.stages == store.Stages(1)
+    assert np.allclose(module.Relative('X')['A'], [0.0, 40.0, 5.0])
+    assert module.passed and not module.failures
+
+def test_store_matches_single_module_surveys(tmp_path):
+    infile = WriteStave(tmp_path, {1: MODULE_1, 2: MODULE_2})
+    store = survey.SurveyStore.FromFiles('S1', infile, [1, 2])
+    for row, module in enumerate([1, 2]):
+        alone = survey.TheSurvey(module, 'S1', infile)
+        together = survey.TheSurvey(module, 'S1', infile, store)
+        assert alone.stages == together.stages
+        assert alone.Relative('X').equals(together.Relative('X'))
+        assert alone.angles.equals(together.angles)
+        assert alone.passed == together.passed
+
+def test_parse_survey_without_spaces(tmp_path):
+    path = tmp_path.joinpath('Module_1.txt')
+    path.write_text('[CornerA]\n' + ''.join('X_' + str(i) + '=1\n' for i in range(64)))
+    stages, values, errors = survey.ParseSurvey(str(path))
+    assert len(stages) == 64 and not errors
+    assert np.all(values[0, :, 0] == 1)
+
+def RunScript(infile, results, *options):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'survey.py')
+    subprocess.run([sys.executable, script, infile, results, 'S1', '--workers', '1'] + list(options), check=True, stdout=subprocess.DEVNULL)
+    with open(results + '/survey_cache.pkl', 'rb') as f_in:
+        return pickle.load(f_in)['entries']
+
+def test_cached_placements_depend_only_on_their_own_file(tmp_path):
+    stave = tmp_path.joinpath('S1')
+    stave.mkdir()
+    infile = WriteStave(stave, {1: MODULE_1, 2: MODULE_2})
+    RunScript(infile, str(tmp_path.joinpath('incremental')))
+
+    # Module_1 gets the stage it skipped, which changes the stave-wide stage order; Module_2's
+    # cached entry is reused, and must be what a fresh run gives
+    WriteStave(stave, {1: MODULE_1 + 'X_Before Bridge Removal = 1.002\nY_Before Bridge Removal = 2.002\n'})
+    incremental = RunScript(infile, str(tmp_path.joinpath('incremental')))
+    rebuilt = RunScript(infile, str(tmp_path.joinpath('rebuilt')), '--rebuild')
+
+    for key in [('S1', 1), ('S1', 2)]:
+        assert incremental[key]['hash'] == rebuilt[key]['hash']
+        assert np.allclose(incremental[key]['placements']['X'], rebuilt[key]['placements']['X'], equal_nan=True)
+        assert np.allclose(incremental[key]['placements']['Y'], rebuilt[key]['placements']['Y'], equal_nan=True)
+    assert np.allclose(incremental[('S1', 2)]['placements']['X'][:1], [5.0])
+
+def test_database_uses_each_module_s_own_stage_order(tmp_path):
+    import survey_db
+    infile = WriteStave(tmp_path, {1: MODULE_1, 2: MODULE_2})
+    with survey_db.SurveyDatabase(str(tmp_path.joinpath('surveys.sqlite'))) as db:
+        assert db.Ingest('S1', infile) == [1, 2]
+        assert db.Ingest('S1', infile) == []
+
+        rows = db.Query(module=2, corner='A')
+        assert list(rows['stage']) == ['After Gluing', 'Before Bridge Removal', 'After Bridge Removal']
+        assert list(rows['stage_index']) == [0, 1, 2]
+        assert list(rows['last']) == [0, 0, 1]
+
+        assert np.allclose(db.Placements(corners='A')['X'], [1.0, 5.0])
+        assert len(db.Failures()) == 0
+        assert list(db.FailureRates()['failed']) == [0, 0, 0, 0]
+        drift = db.Drift(corner='A')
+        assert list(drift['stage']) == ['After Gluing', 'Before Bridge Removal', 'After Bridge Removal']
+
+def test_plots_save_to_the_given_directory(tmp_path):
+    infile = WriteStave(tmp_path, {2: MODULE_2})
+    results = str(tmp_path.joinpath('results'))
+    module = survey.TheSurvey(2, 'S1', infile)
+    module.PlotMovement(results, printOut=False)
+    module.PlotAngle(results, reference='absolute', printOut=False)
+    survey.PlotHistogram(results, {'X': [1.0, 5.0], 'Y': [0.0, 0.0]}, 'ABCD')
+    assert sorted(os.listdir(results)) == ['X-CornersABCD-histogram.png', 'Y-CornersABCD-histogram.png',
+                                           'angle-absolute-' + module.name + '.png', 'position-relative-' + module.name + '.png']
+
+def test_watch_reports_modules_without_measurements(tmp_path, capsys):
+    import survey_watch
+    infile = WriteStave(tmp_path, {1: '', 2: '[CornerA]\n', 3: MODULE_2})
+    watcher = survey_watch.StaveWatcher('S1', infile)
+    watcher.Report(watcher.Poll())
+    watcher.Report(watcher.Poll())
+
+    assert watcher.results[1]['passed'] is None and watcher.results[2]['passed'] is None
+    assert watcher.results[3]['passed'] is True
+    summary = watcher.Summary()
+    assert (summary['passed'], summary['failed'], summary['unmeasured']) == (1, [], [1, 2])
+    out = capsys.readouterr().out
+    assert 'Module 1: no measurements' in out and 'Module 2: no measurements' in out
+    assert '1/1 modules within 25 um, no measurements: 1, 2' in out